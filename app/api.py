@@ -1,23 +1,131 @@
+import os
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
-
-from rf_api_client import RfApiClient
-from rf_api_client.models.files_api_models import UploadFileResponseDto
-from rf_api_client.models.node_types_api_models import NodePropertyType
-from rf_api_client.models.nodes_api_models import CreateNodePropertiesDto, CreateNodeDto, PositionType, NodeDto, \
-    NodeInsertOptions, NodeTreeDto, NodeUpdateDto, PropertiesUpdateDto, UserPropertyCreateDto, FileInfoDto, \
-    FilePropertyValue
-from rf_api_client.models.tags_api_models import TaggedNodeDto
-from rf_api_client.models.users_api_models import UserDto
-from rf_api_client.rf_api_client import UserAuth
+from typing import AsyncIterator, Awaitable, BinaryIO, List, Optional, Set, Tuple, Union, TYPE_CHECKING
 
 from app.db import UserContext
+from app.logger import logger
+from utils.cache import TTLCache
 
+# rf_api_client pulls pydantic and all the models, it is imported on the first request (or by the startup warm-up)
+if TYPE_CHECKING:
+    from aiohttp import TCPConnector
+    from rf_api_client import RfApiClient
+    from rf_api_client.models.nodes_api_models import NodeDto, NodeTreeDto, FileInfoDto, UserPropertyCreateDto
+    from rf_api_client.models.tags_api_models import TaggedNodeDto
+    from rf_api_client.models.users_api_models import UserDto
 
-async def login_to_rf(username: str, password: str) -> UserDto:
-    async with RfApiClient(
-        auth=UserAuth(username=username, password=password)
-    ) as rf:
+
+# seconds for a whole request to RedForester, the default of RfApiClient
+RF_TIMEOUT = 60
+
+# seconds for a whole file upload, 0 is no limit. The large files from the local Bot API server take minutes.
+RF_UPLOAD_TIMEOUT = float(os.getenv('RF_KEEPER_RF_UPLOAD_TIMEOUT', '3600'))
+
+
+# RedForester clients kept open for the recent users
+RF_CLIENTS = int(os.getenv('RF_KEEPER_RF_CLIENTS', '100'))
+
+
+class RfClientPool:
+    """
+    Keeps the RedForester clients of the recent users open, all of them on one connector,
+    so the requests reuse the connections instead of a new TCP and TLS handshake each.
+    The least recently used clients above max_clients are closed once their requests are done.
+    """
+
+    def __init__(self, max_clients: int):
+        self._max_clients = max_clients
+
+        # (username, password, timeout) -> client, the least recently used first
+        self._clients: 'OrderedDict[Tuple[str, str, Optional[float]], RfApiClient]' = OrderedDict()
+
+        # client -> requests in progress
+        self._in_use: Counter = Counter()
+
+        # the clients out of the pool which are still in use
+        self._evicted: Set['RfApiClient'] = set()
+
+        self._connector: Optional['TCPConnector'] = None
+
+    def _create(self, username: str, password: str, timeout: Optional[float]) -> 'RfApiClient':
+        from aiohttp import ClientTimeout, TCPConnector
+        from rf_api_client.rf_api_client import UserAuth
+        from app.rf_client import SharedConnectorRfApiClient
+
+        if self._connector is None or self._connector.closed:
+            self._connector = TCPConnector()
+
+        return SharedConnectorRfApiClient(
+            auth=UserAuth(username=username, password=password),
+            connector=self._connector,
+            # None disables it
+            timeout=ClientTimeout(total=timeout),
+        )
+
+    @asynccontextmanager
+    async def client(self, username: str, password: str, timeout: Optional[float]) -> AsyncIterator['RfApiClient']:
+        key = (username, password, timeout)
+        client = self._clients.get(key)
+
+        if client is None:
+            client = self._clients[key] = self._create(username, password, timeout)
+        else:
+            self._clients.move_to_end(key)
+
+        self._in_use[client] += 1
+        await self._evict()
+
+        try:
+            yield client
+        finally:
+            self._in_use[client] -= 1
+
+            if not self._in_use[client]:
+                del self._in_use[client]
+
+                if client in self._evicted:
+                    self._evicted.discard(client)
+                    await client.close_session()
+
+    async def _evict(self):
+        while len(self._clients) > self._max_clients:
+            _, client = self._clients.popitem(last=False)
+
+            if client in self._in_use:
+                self._evicted.add(client)
+            else:
+                await client.close_session()
+
+    def __len__(self):
+        return len(self._clients)
+
+    async def close(self):
+        clients = [*self._clients.values(), *self._evicted]
+        self._clients.clear()
+        self._evicted.clear()
+
+        for client in clients:
+            await client.close_session()
+
+        if self._connector is not None:
+            await self._connector.close()
+
+
+rf_clients = RfClientPool(RF_CLIENTS)
+
+
+def _rf_client(username: str, password: str, read_timeout: Optional[float] = RF_TIMEOUT):
+    """
+    The client from the pool for the requests of the async with block, read_timeout is for the whole request
+    """
+    return rf_clients.client(username, password, read_timeout)
+
+
+async def login_to_rf(username: str, password: str) -> 'UserDto':
+    async with _rf_client(username, password) as rf:
         user = await rf.users.get_current()
 
         if user.username == 'nobody':
@@ -26,58 +134,130 @@ async def login_to_rf(username: str, password: str) -> UserDto:
         return user
 
 
-async def get_favorite_nodes(ctx: UserContext) -> List[TaggedNodeDto]:
-    async with RfApiClient(
-        auth=UserAuth(username=ctx.username, password=ctx.password)
-    ) as rf:
+async def get_favorite_nodes(ctx: UserContext) -> List['TaggedNodeDto']:
+    async with _rf_client(ctx.username, ctx.password) as rf:
         current = await rf.users.get_current()
         favorite_tag = current.tags[0]
 
         return await rf.tags.get_nodes(favorite_tag.id)
 
 
-async def get_node(ctx: UserContext, node_id: str) -> NodeDto:
-    async with RfApiClient(
-            auth=UserAuth(username=ctx.username, password=ctx.password)
-    ) as rf:
+async def get_node(ctx: UserContext, node_id: str) -> 'NodeDto':
+    async with _rf_client(ctx.username, ctx.password) as rf:
         return await rf.nodes.get_by_id(node_id)
 
 
-async def create_node(ctx: UserContext, map_id: str, parent_id: str, title: str, files: Optional[List[FileInfoDto]] = None) -> NodeDto:
-    async with RfApiClient(
-        auth=UserAuth(username=ctx.username, password=ctx.password)
-    ) as rf:
-        props = CreateNodePropertiesDto.empty()
-        props.global_.title = title
+# (username, node id) -> node, the same destinations are looked up again and again
+destination_nodes: TTLCache['NodeDto'] = TTLCache(ttl=float(os.getenv('RF_KEEPER_NODE_CACHE_TTL', '300')), max_size=5000)
+
+
+async def get_destination_node(ctx: UserContext, node_id: str) -> 'NodeDto':
+    """
+    get_node for the nodes to save or move to, the saving itself fails if the cached node is gone
+    """
+    node = destination_nodes.get((ctx.username, node_id))
+
+    if node is None:
+        node = await get_node(ctx, node_id)
+        destination_nodes.set((ctx.username, node_id), node)
+
+    return node
+
+
+def forget_destination_node(ctx: UserContext, node_id: str):
+    destination_nodes.delete((ctx.username, node_id))
+
+
+def _files_property(files: List['FileInfoDto']) -> 'UserPropertyCreateDto':
+    from rf_api_client.models.node_types_api_models import NodePropertyType
+    from rf_api_client.models.nodes_api_models import UserPropertyCreateDto, FilePropertyValue
+
+    return UserPropertyCreateDto(
+        group='byUser',
+        key='Files',
+        type_id=NodePropertyType.FILE,
+        visible=True,
+        value=FilePropertyValue.to_string(files),
+    )
+
+
+async def _create_node(rf: 'RfApiClient', map_id: str, parent_id: str, title: str, files: Optional[List['FileInfoDto']]) -> 'NodeDto':
+    from rf_api_client.models.nodes_api_models import CreateNodePropertiesDto, CreateNodeDto, PositionType, \
+        NodeUpdateDto, PropertiesUpdateDto
+
+    props = CreateNodePropertiesDto.empty()
+    props.global_.title = title
+
+    node = await rf.nodes.create(CreateNodeDto(
+        map_id=map_id,
+        parent=parent_id,
+        position=(PositionType.P, '-1'),
+        properties=props
+    ))
+
+    if files:
+        # RedForester can not create node with user property.
+        node = await rf.nodes.update_by_id(node.id, NodeUpdateDto(
+            properties=PropertiesUpdateDto(
+                add=[_files_property(files)]
+            )
+        ))
+
+    return node
+
+
+async def create_node(ctx: UserContext, map_id: str, parent_id: str, title: str, files: Optional[List['FileInfoDto']] = None) -> 'NodeDto':
+    async with _rf_client(ctx.username, ctx.password) as rf:
+        return await _create_node(rf, map_id, parent_id, title, files)
+
+
+NodeContent = Tuple[str, Optional[List['FileInfoDto']]]
+
+
+async def create_nodes(ctx: UserContext, map_id: str, parent_id: str, contents: List[Awaitable[NodeContent]]) -> List[Optional['NodeDto']]:
+    """
+    Creates the nodes in the given order through a single session.
+    Each content is awaited right before its node is created, so the next contents may still be in progress.
+    The node is None if its content or the creation has failed.
+    """
+    nodes = []
+
+    async with _rf_client(ctx.username, ctx.password) as rf:
+        for content in contents:
+            try:
+                title, files = await content
+                nodes.append(await _create_node(rf, map_id, parent_id, title, files))
+            except Exception as e:
+                logger.exception(e)
+                nodes.append(None)
 
-        node = await rf.nodes.create(CreateNodeDto(
-            map_id=map_id,
-            parent=parent_id,
-            position=(PositionType.P, '-1'),
-            properties=props
+    return nodes
+
+
+async def update_node_content(ctx: UserContext, node_id: str, title: Optional[str], files: Optional[List['FileInfoDto']]) -> 'NodeDto':
+    """
+    Attaches files to the existing node, the title is updated if specified
+    """
+    from rf_api_client.models.nodes_api_models import NodeUpdateDto, PropertiesUpdateDto, GlobalPropertyUpdateDto
+
+    async with _rf_client(ctx.username, ctx.password) as rf:
+        return await rf.nodes.update_by_id(node_id, NodeUpdateDto(
+            properties=PropertiesUpdateDto(
+                add=[_files_property(files)] if files else None,
+                update=[GlobalPropertyUpdateDto(value=title)] if title is not None else None,
+            )
         ))
 
-        if files:
-            # RedForester can not create node with user property.
-            node = await rf.nodes.update_by_id(node.id, NodeUpdateDto(
-                properties=PropertiesUpdateDto(
-                    add=[UserPropertyCreateDto(
-                        group='byUser',
-                        key='Files',
-                        type_id=NodePropertyType.FILE,
-                        visible=True,
-                        value=FilePropertyValue.to_string(files),
-                    )]
-                )
-            ))
-
-        return node
-
-
-async def move_node(ctx: UserContext, node_id: str, new_parent_id: str) -> NodeTreeDto:
-    async with RfApiClient(
-            auth=UserAuth(username=ctx.username, password=ctx.password)
-    ) as rf:
+
+async def delete_node(ctx: UserContext, node_id: str):
+    async with _rf_client(ctx.username, ctx.password) as rf:
+        await rf.nodes.delete_by_id(node_id)
+
+
+async def move_node(ctx: UserContext, node_id: str, new_parent_id: str) -> 'NodeTreeDto':
+    from rf_api_client.models.nodes_api_models import NodeInsertOptions
+
+    async with _rf_client(ctx.username, ctx.password) as rf:
         resp = await rf.nodes.insert_to(
             node_id=node_id,
             new_parent_id=new_parent_id,
@@ -87,16 +267,23 @@ async def move_node(ctx: UserContext, node_id: str, new_parent_id: str) -> NodeT
         return resp.root
 
 
-class UploadFileData(UploadFileResponseDto):
+@dataclass
+class UploadFileData:
+    user_id: str
+    file_id: str
     base_url: str
     file_name: str
     timestamp: datetime
 
+    # real size of the uploaded image, if it has been preprocessed
+    image_size: Optional[Tuple[int, int]] = None
+
 
-async def upload_file(ctx: UserContext, file: bytes, file_name: str) -> UploadFileData:
-    async with RfApiClient(
-            auth=UserAuth(username=ctx.username, password=ctx.password)
-    ) as rf:
+async def upload_file(ctx: UserContext, file: Union[bytes, BinaryIO], file_name: str) -> UploadFileData:
+    """
+    The file object is streamed by aiohttp in chunks, the upload is limited by RF_UPLOAD_TIMEOUT only
+    """
+    async with _rf_client(ctx.username, ctx.password, read_timeout=RF_UPLOAD_TIMEOUT or None) as rf:
         resp = await rf.files.upload_file_bytes(file)
         return UploadFileData(
             user_id=resp.user_id,
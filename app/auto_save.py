@@ -0,0 +1,145 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from app.api import get_node, get_destination_node
+from app.db import UserContext, get_or_create_context, create_node_context, update_node_context, \
+    get_last_node_context, release_node_contexts
+from app.logger import logger
+from content_handler import ContentHandler
+from messages import Messages
+from utils.admission import AdmissionController, BusyException
+from utils.bot import use_bot
+from utils.rf_links import link_to_node
+
+
+class AutoSaveQueue:
+    """
+    Collects the messages of the chats in the auto-save mode for a short time after the first one,
+    then saves the whole batch to the auto-save destination and reports it with a single status message
+    """
+
+    def __init__(self, bot, delay: float, admission: AdmissionController):
+        self._bot = bot
+        self._delay = delay
+        self._admission = admission
+        self._pending: Dict[int, List] = {}
+        self._flushers: Dict[int, asyncio.Task] = {}
+
+        # set by flush_now on the shutdown, the messages handled after that are not delayed
+        self._stopping = False
+
+    def add(self, message):
+        chat_id = message.chat.id
+
+        self._pending.setdefault(chat_id, []).append(message)
+
+        if chat_id not in self._flushers:
+            flush = self._flush(chat_id) if self._stopping else self._flush_later(chat_id)
+            self._flushers[chat_id] = asyncio.ensure_future(flush)
+
+    def flush_now(self):
+        """
+        Starts saving all the collected batches without waiting, and the ones collected later right away
+        """
+        self._stopping = True
+
+        for chat_id, flusher in list(self._flushers.items()):
+            flusher.cancel()
+            self._flushers[chat_id] = asyncio.ensure_future(self._flush(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self._delay)
+        await self._flush(chat_id)
+
+    async def _resolve_destination(self, chat_id: int, ctx: UserContext) -> Optional[Tuple[str, str]]:
+        """
+        Map id and parent node id to save to
+        """
+        if ctx.auto_save_node_id:
+            async with self._admission.slot(chat_id):
+                node = await get_destination_node(ctx, ctx.auto_save_node_id)
+
+            return node.map_id, node.id
+
+        last_node_ctx = get_last_node_context(ctx)
+
+        if not last_node_ctx:
+            return None
+
+        async with self._admission.slot(chat_id):
+            last_node = await get_node(ctx, last_node_ctx.node_id)
+
+        return last_node.map_id, last_node.parent
+
+    async def _flush(self, chat_id: int):
+        # flush_now is called outside of the update handling
+        use_bot(self._bot)
+
+        self._flushers.pop(chat_id, None)
+        messages = self._pending.pop(chat_id, [])
+
+        if not messages:
+            return
+
+        try:
+            await self._save_batch(chat_id, messages)
+        except Exception as e:
+            logger.exception(e)
+
+    async def _save_batch(self, chat_id: int, messages: List):
+        _, ctx = get_or_create_context(messages[0])
+
+        status = await self._bot.send_message(chat_id, Messages.auto_save_started.format(count=len(messages)))
+
+        # claimed until the batch is done, the messages not saved are left for /saveall
+        node_contexts = [create_node_context(ctx, message, status, claimed=True) for message in messages]
+
+        try:
+            await self._save_claimed(chat_id, ctx, status, messages)
+        finally:
+            release_node_contexts([node_ctx.id for node_ctx in node_contexts])
+
+    async def _save_claimed(self, chat_id: int, ctx: UserContext, status, messages: List):
+        try:
+            destination = await self._resolve_destination(chat_id, ctx)
+        except BusyException:
+            # left pending for /saveall
+            self._bot.tenant.count('busy')
+
+            return await self._bot.edit_message_text(chat_id=chat_id, message_id=status.message_id, text=Messages.busy)
+        except Exception as e:
+            logger.exception(e)
+            destination = None
+
+        if not destination:
+            return await self._bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=status.message_id,
+                text=Messages.auto_save_destination_not_found,
+            )
+
+        map_id, parent_id = destination
+        handler = ContentHandler(self._bot)
+        saved = 0
+
+        # one by one, to keep the order of the messages
+        for message in messages:
+            try:
+                async with self._admission.slot(chat_id):
+                    node = await handler.save(ctx, map_id, parent_id, message)
+
+                update_node_context(ctx, message, node.id)
+                saved += 1
+            except BusyException:
+                pass  # left pending for /saveall
+            except Exception as e:
+                logger.exception(e)
+
+        self._bot.tenant.count('saved', saved)
+        self._bot.tenant.count('save_failed', len(messages) - saved)
+
+        text = Messages.messages_saved.format(count=saved, destination_url=link_to_node(map_id, parent_id))
+        if saved < len(messages):
+            text += '\n' + Messages.messages_save_failed.format(count=len(messages) - saved)
+
+        await self._bot.edit_message_text(chat_id=chat_id, message_id=status.message_id, text=text)
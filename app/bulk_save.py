@@ -0,0 +1,67 @@
+import asyncio
+from typing import List, Tuple, TYPE_CHECKING
+
+from telebot import types
+
+from app.api import NodeContent, create_nodes
+from app.db import UserContext, SavedNodeContext, claim_pending_node_contexts, update_node_contexts, \
+    release_node_contexts
+from content_handler import ContentHandler
+from utils.admission import AdmissionController
+from utils.preview import enrich_html
+
+if TYPE_CHECKING:
+    from rf_api_client.models.nodes_api_models import NodeDto
+
+
+async def save_pending(bot, ctx: UserContext, map_id: str, parent_id: str, admission: AdmissionController,
+                       max_uploads: int) -> Tuple[List[Tuple[SavedNodeContext, 'NodeDto']], int]:
+    """
+    Saves all the messages which have not been saved yet under one destination node, in the order they were received.
+    The messages being saved by another save are skipped.
+    Up to max_uploads media files are uploaded concurrently, each in the admission slot of the user,
+    while the nodes are created one by one.
+    Returns the saved node contexts with their nodes and the count of the messages that could not be saved.
+    """
+    pending = claim_pending_node_contexts(ctx)
+
+    try:
+        saved = await _save_node_contexts(bot, ctx, map_id, parent_id, admission, max_uploads, pending)
+    finally:
+        release_node_contexts([node_ctx.id for node_ctx in pending])
+
+    return saved, len(pending) - len(saved)
+
+
+async def _save_node_contexts(bot, ctx: UserContext, map_id: str, parent_id: str, admission: AdmissionController,
+                              max_uploads: int, pending: List[SavedNodeContext]) \
+        -> List[Tuple[SavedNodeContext, 'NodeDto']]:
+    handler = ContentHandler(bot)
+    uploads = asyncio.Semaphore(max_uploads)
+
+    async def get_content(node_ctx: SavedNodeContext) -> NodeContent:
+        # BusyException fails the message, it stays pending
+        async with uploads, admission.slot(int(ctx.chat_id)):
+            prepared = handler.prepare(types.Message.de_json(node_ctx.message_json))
+            prepared = prepared._replace(body=await enrich_html(prepared.body))
+
+            if not prepared.file_id:
+                return prepared.content, None
+
+            upload_info = await handler.upload(ctx, prepared)
+
+        return handler.complete(prepared, upload_info)
+
+    contents = [asyncio.ensure_future(get_content(node_ctx)) for node_ctx in pending]
+
+    try:
+        nodes = await create_nodes(ctx, map_id, parent_id, contents)
+    finally:
+        for content in contents:
+            content.cancel()
+
+    saved = [(node_ctx, node) for node_ctx, node in zip(pending, nodes) if node]
+
+    update_node_contexts({node_ctx.id: node.id for node_ctx, node in saved})
+
+    return saved
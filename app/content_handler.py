@@ -1,20 +1,56 @@
-from typing import Optional
-
-from pathvalidate import sanitize_filename
-from rf_api_client.models.nodes_api_models import FileInfoDto
+import asyncio
+from typing import List, NamedTuple, Optional, Tuple, TYPE_CHECKING
 
 from db import UserContext
-from api import UploadFileData, upload_file
+from api import UploadFileData, upload_file, create_node, update_node_content, delete_node
+from app.logger import logger
 from exceptions import AppException
+from utils.bot_api import is_local_file, local_file_path
 from utils.file_guess import guess_file_extension
+from utils.images import IMAGE_MAX_BYTES, image_preprocessor
 from utils.html import tg_html_to_rf_html, CUSTOM_SUBS
+from utils.preview import enrich_html
 from utils.rf_links import link_to_file
 
+if TYPE_CHECKING:
+    from rf_api_client.models.nodes_api_models import FileInfoDto, NodeDto
+
 
 class UnsupportedContentException(AppException):
     pass
 
 
+def sanitize_filename(file_name: str) -> str:
+    from pathvalidate import sanitize_filename as _sanitize_filename  # imported on the first use
+
+    return _sanitize_filename(file_name)
+
+
+class PreparedContent(NamedTuple):
+    # forwarded source, if any
+    forwarded: str
+
+    # caption or the whole text
+    body: str
+
+    # the media to upload, if any
+    file_id: Optional[str] = None
+    file_name: Optional[str] = None
+
+    # photo size, the image tag is added to the content after the upload
+    image_size: Optional[Tuple[int, int]] = None
+
+    # the document is an image, it is downscaled before the upload if oversized
+    is_image: bool = False
+
+    @property
+    def content(self) -> str:
+        """
+        Node content known before the upload
+        """
+        return self.forwarded + self.body
+
+
 class ContentHandler:
     SUPPORTED_TYPES = ['text', 'photo', 'audio', 'voice', 'video', 'video_note', 'document']
     ALL_TYPES = [*SUPPORTED_TYPES, 'location', 'venue', 'contact', 'sticker', 'animation']
@@ -28,24 +64,54 @@ class ContentHandler:
 
     async def _upload_file(self, ctx: UserContext, file_id: str, file_name: str) -> UploadFileData:
         file_info = await self._bot.get_file(file_id)
+
+        if is_local_file(file_info.file_path):
+            # streamed from the disk by chunks, the file is never loaded into the memory as a whole
+            with open(local_file_path(file_info.file_path), 'rb') as file:
+                return await upload_file(ctx, file, file_name)
+
         file_content = await self._bot.download_file(file_info.file_path)
 
         return await upload_file(ctx, file_content, file_name)
 
-    @staticmethod
-    def _process_media(upload_info: UploadFileData, caption: Optional[str]):
-        return (
-            tg_html_to_rf_html(caption) if caption else '',
-            [FileInfoDto(
-                name=upload_info.file_name,
-                filepath=upload_info.file_id,
-                last_modified_timestamp=upload_info.timestamp,
-                last_modified_user=upload_info.user_id
-            )]
-        )
+    async def _download_file(self, file_path: str) -> bytes:
+        if not is_local_file(file_path):
+            return await self._bot.download_file(file_path)
+
+        def read():
+            with open(local_file_path(file_path), 'rb') as file:
+                return file.read()
+
+        return await asyncio.get_event_loop().run_in_executor(None, read)
+
+    async def _upload_image(self, ctx: UserContext, prepared: PreparedContent) -> UploadFileData:
+        """
+        Downscales and recompresses the image in the process pool, the original is uploaded if it can not be processed
+        """
+        file_info = await self._bot.get_file(prepared.file_id)
+
+        if file_info.file_size and file_info.file_size > IMAGE_MAX_BYTES:
+            return await self._upload_file(ctx, prepared.file_id, prepared.file_name)
+
+        file_content = await self._download_file(file_info.file_path)
+
+        try:
+            # the photos are compressed by Telegram anyway, the documents are changed only if they are too large
+            image = await image_preprocessor.process(file_content, only_oversized=prepared.is_image)
+        except Exception as e:
+            logger.exception(e)
+            image = None
+
+        if image is None:
+            return await upload_file(ctx, file_content, prepared.file_name)
+
+        upload_info = await upload_file(ctx, image.data, prepared.file_name)
+        upload_info.image_size = (image.width, image.height)
+
+        return upload_info
 
     @staticmethod
-    def _process_forwarded(message, content: str) -> str:
+    def _process_forwarded(message) -> str:
         source_url = None
 
         if message.forward_from:
@@ -66,58 +132,152 @@ class ContentHandler:
                     source_url += f'/{message.forward_from_message_id}'
 
         else:
-            return content
+            return ''
 
         source = f'<a href="{source_url}" target="_blank">{source_title}</a>' if source_url else source_title
-        return f'<p>Forwarded from {source}:</p>' + content
+        return f'<p>Forwarded from {source}:</p>'
 
-    async def handle(self, ctx: UserContext, message):
+    def prepare(self, message) -> PreparedContent:
+        """
+        Converts the message to the node content without touching the network
+        """
         # html formatting customization
         message.custom_subs = CUSTOM_SUBS
 
+        forwarded = self._process_forwarded(message)
+
         if message.text:
-            content = tg_html_to_rf_html(message.html_text)
-            files = None
+            return PreparedContent(forwarded=forwarded, body=tg_html_to_rf_html(message.html_text))
 
-        elif message.photo:
-            photo = message.photo[-1]  # best quality photo
+        caption = tg_html_to_rf_html(message.html_caption) if message.html_caption else ''
 
-            file_name = f'image.jpg'  # always jpeg
-            upload_info = await self._upload_file(ctx, photo.file_id, file_name)
-            content, files = self._process_media(upload_info, message.html_caption)
+        if message.photo:
+            photo = message.photo[-1]  # best quality photo
 
-            url = link_to_file(upload_info.file_id, file_name)
-            content = f'<p><img src="{url}" height="{photo.height}" width="{photo.width}"></p>' + content
+            return PreparedContent(
+                forwarded=forwarded,
+                body=caption,
+                file_id=photo.file_id,
+                file_name='image.jpg',  # always jpeg
+                image_size=(photo.width, photo.height),
+            )
 
         elif message.audio:
             file_extension = guess_file_extension(message.audio.mime_type)
             file_name = sanitize_filename(
                 f'{message.audio.title or "Unknown"} - {message.audio.performer or "Unknown"}{file_extension}')
-            content, files = self._process_media(await self._upload_file(ctx, message.audio.file_id, file_name), message.html_caption)
+            return PreparedContent(forwarded=forwarded, body=caption, file_id=message.audio.file_id, file_name=file_name)
 
         elif message.voice:
             # always .oga?
             file_extension = guess_file_extension(message.voice.mime_type)
             file_name = sanitize_filename(
                 f'{message.voice.title or "Unknown"} - {message.voice.performer or "Unknown"}{file_extension}')
-            content, files = self._process_media(await self._upload_file(ctx, message.voice.file_id, file_name), message.html_caption)
+            return PreparedContent(forwarded=forwarded, body=caption, file_id=message.voice.file_id, file_name=file_name)
 
         elif message.video:
             file_extension = guess_file_extension(message.video.mime_type)
             file_name = f'video{file_extension}'
-            content, files = self._process_media(await self._upload_file(ctx, message.video.file_id, file_name), message.html_caption)
+            return PreparedContent(forwarded=forwarded, body=caption, file_id=message.video.file_id, file_name=file_name)
 
         elif message.video_note:
             file_name = 'video_note.mp4'  # video_note has no mime type
-            content, files = self._process_media(await self._upload_file(ctx, message.video_note.file_id, file_name), message.html_caption)
+            return PreparedContent(forwarded=forwarded, body=caption, file_id=message.video_note.file_id, file_name=file_name)
 
         elif message.document:
             file_name = sanitize_filename(message.document.file_name or 'unknown')
-            content, files = self._process_media(await self._upload_file(ctx, message.document.file_id, file_name), message.html_caption)
+            return PreparedContent(
+                forwarded=forwarded,
+                body=caption,
+                file_id=message.document.file_id,
+                file_name=file_name,
+                is_image=(message.document.mime_type or '').startswith('image/'),
+            )
 
-        else:
-            raise UnsupportedContentException()
+        raise UnsupportedContentException()
+
+    async def upload(self, ctx: UserContext, prepared: PreparedContent) -> UploadFileData:
+        if image_preprocessor.enabled and (prepared.image_size or prepared.is_image):
+            return await self._upload_image(ctx, prepared)
+
+        return await self._upload_file(ctx, prepared.file_id, prepared.file_name)
+
+    @staticmethod
+    def complete(prepared: PreparedContent, upload_info: UploadFileData) -> Tuple[str, List['FileInfoDto']]:
+        """
+        Node content and file property after the upload
+        """
+        from rf_api_client.models.nodes_api_models import FileInfoDto
+
+        content = prepared.content
+
+        if prepared.image_size:
+            url = link_to_file(upload_info.file_id, prepared.file_name)
+            width, height = upload_info.image_size or prepared.image_size
+            content = prepared.forwarded + f'<p><img src="{url}" height="{height}" width="{width}"></p>' + prepared.body
+
+        return content, [FileInfoDto(
+            name=upload_info.file_name,
+            filepath=upload_info.file_id,
+            last_modified_timestamp=upload_info.timestamp,
+            last_modified_user=upload_info.user_id
+        )]
+
+    async def handle(self, ctx: UserContext, message):
+        prepared = self.prepare(message)
+
+        if not prepared.file_id:
+            return prepared.content, None
+
+        return self.complete(prepared, await self.upload(ctx, prepared))
+
+    async def save(self, ctx: UserContext, map_id: str, parent_id: str, message) -> 'NodeDto':
+        """
+        Creates the node while the media is being uploaded and the link previews are fetched,
+        then attaches the file and the previews to it.
+        The node is deleted if the upload or the attachment fails, the previews are optional.
+        """
+        prepared = self.prepare(message)
+        enrich_task = asyncio.ensure_future(enrich_html(prepared.body))
+
+        if not prepared.file_id:
+            node = await create_node(ctx, map_id, parent_id, prepared.content)
+            body = await enrich_task
+
+            if body == prepared.body:
+                return node
+
+            try:
+                return await update_node_content(ctx, node.id, title=prepared.forwarded + body, files=None)
+            except Exception as e:
+                logger.exception(e)
+                return node
+
+        upload_task = asyncio.ensure_future(self.upload(ctx, prepared))
+
+        try:
+            node = await create_node(ctx, map_id, parent_id, prepared.content)
+        except BaseException:
+            upload_task.cancel()
+            enrich_task.cancel()
+            raise
+
+        try:
+            upload_info = await upload_task
+            content, files = self.complete(prepared._replace(body=await enrich_task), upload_info)
+
+            return await update_node_content(
+                ctx,
+                node.id,
+                title=content if content != prepared.content else None,
+                files=files
+            )
+        except BaseException:
+            enrich_task.cancel()
 
-        content = self._process_forwarded(message, content)
+            try:
+                await delete_node(ctx, node.id)
+            except Exception as e:
+                logger.exception(e)
 
-        return content, files
+            raise
@@ -1,8 +1,17 @@
+import json
 import os
+import weakref
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 
-from peewee import Model, CharField, BooleanField, ForeignKeyField, DatabaseProxy, PostgresqlDatabase, BigIntegerField
+from peewee import Model, CharField, BooleanField, ForeignKeyField, DatabaseProxy, PostgresqlDatabase, BigIntegerField, \
+    TextField, Case, DateTimeField, OperationalError, InterfaceError
+from playhouse.migrate import PostgresqlMigrator, migrate
+from playhouse.pool import PooledPostgresqlDatabase
+from playhouse.shortcuts import ReconnectMixin
 
 from app.logger import logger
+from app.tenants import current_tenant
 from exceptions import AppException
 
 db = DatabaseProxy()
@@ -15,10 +24,21 @@ class BaseModel(Model):
 
 class UserContext(BaseModel):
     chat_id = CharField()
+
+    # the bot the chat is with, None for the primary bot
+    bot_id = CharField(null=True, default=None)
+
     is_authorized = BooleanField(default=False)
     username = CharField(null=True, default=None)
     password = CharField(null=True, default=None)
 
+    # save incoming messages without asking for the destination
+    auto_save = BooleanField(default=False)
+
+    # auto-save destination, the parent of the last saved node is used if not set
+    auto_save_map_id = CharField(null=True, default=None)
+    auto_save_node_id = CharField(null=True, default=None)
+
 
 class SavedNodeContext(BaseModel):
     user_ctx = ForeignKeyField(UserContext, on_delete='CASCADE')
@@ -32,29 +52,222 @@ class SavedNodeContext(BaseModel):
     # created node id
     node_id = CharField(null=True, default=None)
 
+    # user message as received from Telegram, kept until the node is created to save it later in bulk
+    message_json = TextField(null=True, default=None)
+
+    # set while the message is being saved, the other saves skip it
+    claimed_at = DateTimeField(null=True, default=None)
+
     # todo add parent_id?
 
 
+class RecentDestination(BaseModel):
+    """
+    The nodes the user has recently saved or moved to, the labels are kept to show them without RedForester
+    """
+    user_ctx = ForeignKeyField(UserContext, on_delete='CASCADE')
+    map_id = CharField()
+    node_id = CharField()
+    map_name = CharField(default='')
+    title = TextField(default='')
+    used_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = (
+            (('user_ctx', 'node_id'), True),
+        )
+
+
+# recent destinations kept per user
+RECENT_DESTINATIONS_LIMIT = 10
+
+# the claims of the saves interrupted by a restart expire after that
+CLAIM_TIMEOUT = timedelta(hours=1)
+
+
+# 0 keeps the single connection forever, otherwise the connections are recycled after DB_STALE_TIMEOUT.
+# It is not a pool for concurrent queries: peewee keeps a connection per thread and the queries run in the event loop
+# thread, so the loop uses one connection at a time, the others are for the executor threads (create_tables).
+DB_POOL_SIZE = int(os.getenv('RF_KEEPER_DB_POOL_SIZE', '0'))
+
+# recycled connections older than that are closed instead of being reused
+DB_STALE_TIMEOUT = float(os.getenv('RF_KEEPER_DB_STALE_TIMEOUT', '300'))
+
+
+class PostgresReconnectMixin(ReconnectMixin):
+    """
+    Reconnects and retries the query once if the connection was dropped.
+    ReconnectMixin knows only the MySQL errors, these are the psycopg2 ones.
+    """
+    reconnect_errors = (
+        (OperationalError, 'server closed the connection unexpectedly'),
+        (OperationalError, 'terminating connection'),
+        (OperationalError, 'could not receive data from server'),
+        (InterfaceError, 'connection already closed'),
+    )
+
+
+class ReconnectingPostgresqlDatabase(PostgresReconnectMixin, PostgresqlDatabase):
+    pass
+
+
+class ReconnectingPooledPostgresqlDatabase(PostgresReconnectMixin, PooledPostgresqlDatabase):
+    """
+    Same for the recycled connections, the broken one is discarded by the pool
+    """
+
+
 def init_db():
-    db.initialize(PostgresqlDatabase(
-        os.getenv('PGDATABASE'),
+    params = dict(
         user=os.getenv('PGUSER'),
         password=os.getenv('PGPASSWORD'),
         host=os.getenv('PGHOST'),
         port=5432,
         autorollback=True,
-    ))
+    )
+
+    if DB_POOL_SIZE:
+        db.initialize(ReconnectingPooledPostgresqlDatabase(
+            os.getenv('PGDATABASE'),
+            max_connections=DB_POOL_SIZE,
+            stale_timeout=DB_STALE_TIMEOUT,
+            **params,
+        ))
+    else:
+        db.initialize(ReconnectingPostgresqlDatabase(os.getenv('PGDATABASE'), **params))
+
+    if DB_POOL_SIZE:
+        logger.info(f'Database initialized, the connections are recycled after {DB_STALE_TIMEOUT:g}s')
+    else:
+        logger.info('Database initialized')
+
+
+def pool_stats() -> Optional[Dict[str, int]]:
+    """
+    Connections of the pool, None in the single connection mode. The event loop holds one of them at most.
+    """
+    if not isinstance(db.obj, PooledPostgresqlDatabase):
+        return None
+
+    return {
+        'max': db.obj._max_connections,
+        'in_use': len(db.obj._in_use),
+        'idle': len(db.obj._connections),
+    }
+
+
+def check_db_health():
+    """
+    Runs in the event loop thread between the handlers, they do not keep transactions open across awaits.
+    The connection of the thread is returned to the pool, so the stale one is recycled, then the next one is probed.
+    """
+    if isinstance(db.obj, PooledPostgresqlDatabase) and not db.is_closed():
+        db.close()
+
+    db.execute_sql('SELECT 1')
+
+
+def create_tables():
+    """
+    Blocking, runs in the executor thread concurrently with the polling, so it uses its own connection
+    """
+    models = [UserContext, SavedNodeContext, RecentDestination]
+
+    with db.connection_context():
+        db.create_tables(models, safe=True)
+
+        for model in models:
+            _add_missing_columns(model)
+
+    logger.info('Database tables are checked')
+
+
+def _add_missing_columns(model):
+    """
+    create_tables does not alter the existing tables, the columns added to the models later are created here
+    """
+    table = model._meta.table_name
+    existing = {column.name for column in db.get_columns(table)}
+    missing = [field for field in model._meta.sorted_fields if field.column_name not in existing]
+
+    if not missing:
+        return
+
+    migrator = PostgresqlMigrator(db.obj)
+    migrate(*[migrator.add_column(table, field.column_name, field) for field in missing])
+
+    logger.info(f'Columns added to {table}: {", ".join(field.column_name for field in missing)}')
+
+
+def close_db():
+    if not db.is_closed():
+        db.close()
+
+    if isinstance(db.obj, PooledPostgresqlDatabase):
+        db.obj.close_all()
+
+    logger.info('Database connection closed')
 
-    db.create_tables([UserContext, SavedNodeContext], safe=True)
 
-    logger.info('Database initialized')
+def _select_sql(model, where: str, order_by: Optional[str] = None) -> str:
+    columns = ', '.join(f'"{field.column_name}"' for field in model._meta.sorted_fields)
+    sql = f'SELECT {columns} FROM "{model._meta.table_name}" WHERE {where}'
+
+    return f'{sql} ORDER BY {order_by} LIMIT 1' if order_by else f'{sql} LIMIT 1'
+
+
+# the queries of almost every update, prepared once per connection
+HOT_STATEMENTS = {
+    'user_context_by_chat': (UserContext, _select_sql(UserContext, 'chat_id = $1 AND bot_id IS NOT DISTINCT FROM $2')),
+    'node_context_by_message': (SavedNodeContext, _select_sql(SavedNodeContext, 'user_ctx_id = $1 AND message_id = $2')),
+    'last_node_context': (SavedNodeContext, _select_sql(
+        SavedNodeContext, 'user_ctx_id = $1 AND node_id IS NOT NULL', 'id DESC')),
+}
+
+# connection -> names of the statements prepared on it, the closed connections are dropped by the gc
+_prepared_statements = weakref.WeakKeyDictionary()
+
+
+def _execute_hot(name: str, *params):
+    """
+    The first row of the prepared statement as the model instance, or None
+    """
+    model, sql = HOT_STATEMENTS[name]
+    placeholders = ', '.join(['%s'] * len(params))
+
+    _prepare(name, sql)
+    connection = db.connection()
+
+    try:
+        return next(iter(model.raw(f'EXECUTE {name}({placeholders})', *params)), None)
+    except Exception:
+        # the EXECUTE has been retried on the new connection, which does not have the statement yet
+        if db.connection() is connection:
+            raise
+
+    _prepare(name, sql)
+    return next(iter(model.raw(f'EXECUTE {name}({placeholders})', *params)), None)
+
+
+def _prepare(name: str, sql: str):
+    if name not in _prepared_statements.get(db.connection(), ()):
+        db.execute_sql(f'PREPARE {name} AS {sql}')
+        # the connection may be replaced by the reconnect
+        _prepared_statements.setdefault(db.connection(), set()).add(name)
+
+
+def _current_bot_id() -> Optional[str]:
+    tenant = current_tenant.get(None)
+    return tenant.bot_id if tenant else None
 
 
 def get_or_create_context(message):
     chat_id = message.chat.id
-    ctx, created = UserContext.get_or_create(chat_id=chat_id, defaults={'is_authorized': False})
+    bot_id = _current_bot_id()
+    ctx = _execute_hot('user_context_by_chat', str(chat_id), bot_id)
 
-    if created:
+    if ctx is None:
+        ctx = UserContext.create(chat_id=chat_id, bot_id=bot_id, is_authorized=False)
         logger.info(f'New context is created for chat {chat_id}')
 
     return chat_id, ctx
@@ -62,7 +275,11 @@ def get_or_create_context(message):
 
 def del_context(message):
     chat_id = message.chat.id
-    count = UserContext.delete().where(UserContext.chat_id == chat_id).execute()
+    bot_id = _current_bot_id()
+    count = UserContext.delete()\
+        .where(UserContext.chat_id == chat_id)\
+        .where(UserContext.bot_id.is_null() if bot_id is None else UserContext.bot_id == bot_id)\
+        .execute()
 
     if count:
         logger.info(f'Context is deleted for chat {chat_id}')
@@ -72,30 +289,162 @@ class NodeContextNotFoundException(AppException):
     pass
 
 
+class NodeContextClaimedException(AppException):
+    pass
+
+
 def get_node_context(user_ctx, message):
-    try:
-        return SavedNodeContext.get(user_ctx=user_ctx, message_id=message.message_id)
-    except SavedNodeContext.DoesNotExist:
+    node_ctx = _execute_hot('node_context_by_message', user_ctx.id, message.message_id)
+
+    if node_ctx is None:
         raise NodeContextNotFoundException
 
+    return node_ctx
+
 
 def get_last_node_context(user_ctx):
-    try:
-        return SavedNodeContext\
-            .select()\
-            .where(SavedNodeContext.user_ctx == user_ctx)\
-            .where(SavedNodeContext.node_id.is_null(False))\
-            .order_by(SavedNodeContext.id.desc())\
-            .get()
-    except SavedNodeContext.DoesNotExist:
-        return None
+    return _execute_hot('last_node_context', user_ctx.id)
 
 
-def create_node_context(user_ctx, message, reply):
-    return SavedNodeContext.create(user_ctx=user_ctx, message_id=message.message_id, reply_id=reply.message_id)
+def get_pending_node_contexts(user_ctx) -> List[SavedNodeContext]:
+    return list(SavedNodeContext
+                .select()
+                .where(SavedNodeContext.user_ctx == user_ctx)
+                .where(_is_pending())
+                .order_by(SavedNodeContext.id))
+
+
+def _is_pending():
+    # the messages received before the message_json column was added can not be restored, they are never pending
+    return SavedNodeContext.node_id.is_null() & SavedNodeContext.message_json.is_null(False)
+
+
+def create_node_context(user_ctx, message, reply, claimed: bool = False):
+    return SavedNodeContext.create(
+        user_ctx=user_ctx,
+        message_id=message.message_id,
+        reply_id=reply.message_id,
+        message_json=json.dumps(message.json) if isinstance(message.json, dict) else message.json,
+        claimed_at=datetime.now() if claimed else None,
+    )
+
+
+def _is_claimable():
+    return SavedNodeContext.node_id.is_null() & (
+        SavedNodeContext.claimed_at.is_null() | (SavedNodeContext.claimed_at < datetime.now() - CLAIM_TIMEOUT)
+    )
+
+
+def claim_pending_node_contexts(user_ctx) -> List[SavedNodeContext]:
+    """
+    Marks the pending contexts as being saved and returns them in the order they were received.
+    The contexts claimed by another save are skipped.
+    """
+    claimed = SavedNodeContext\
+        .update(claimed_at=datetime.now())\
+        .where(SavedNodeContext.user_ctx == user_ctx)\
+        .where(_is_pending() & _is_claimable())\
+        .returning(SavedNodeContext)\
+        .execute()
+
+    return sorted(claimed, key=lambda node_ctx: node_ctx.id)
+
+
+def claim_node_context(user_ctx, message) -> SavedNodeContext:
+    """
+    Marks the context of the message as being saved, NodeContextClaimedException if it is saved already
+    """
+    claimed = list(SavedNodeContext
+                   .update(claimed_at=datetime.now())
+                   .where(SavedNodeContext.user_ctx == user_ctx)
+                   .where(SavedNodeContext.message_id == message.message_id)
+                   .where(_is_claimable())
+                   .returning(SavedNodeContext)
+                   .execute())
+
+    if not claimed:
+        get_node_context(user_ctx, message)  # NodeContextNotFoundException if there is nothing to claim
+        raise NodeContextClaimedException
+
+    return claimed[0]
+
+
+def release_node_contexts(node_ctx_ids: List[int]):
+    """
+    Gives the contexts which have not been saved back to the other saves, the saved ones are left as is
+    """
+    if not node_ctx_ids:
+        return
+
+    SavedNodeContext\
+        .update(claimed_at=None)\
+        .where(SavedNodeContext.id.in_(node_ctx_ids))\
+        .where(SavedNodeContext.node_id.is_null())\
+        .execute()
+
+
+def update_node_contexts(node_ids: Dict[int, str]):
+    """
+    Sets node ids for many contexts (context id -> node id) with a single statement
+    """
+    if not node_ids:
+        return
+
+    SavedNodeContext\
+        .update(node_id=Case(SavedNodeContext.id, list(node_ids.items())), message_json=None, claimed_at=None)\
+        .where(SavedNodeContext.id.in_(list(node_ids)))\
+        .execute()
 
 
 def update_node_context(user_ctx, message, node_id: str):
     ctx = get_node_context(user_ctx, message)
     ctx.node_id = node_id
+    ctx.message_json = None
+    ctx.claimed_at = None
     ctx.save()
+
+
+def add_recent_destination(user_ctx, map_id: str, node_id: str, title: str, map_name: Optional[str] = None):
+    """
+    Moves the destination to the top, the map name is kept as is if not specified
+    """
+    update = {
+        RecentDestination.map_id: map_id,
+        RecentDestination.title: title,
+        RecentDestination.used_at: datetime.now(),
+    }
+
+    if map_name is not None:
+        update[RecentDestination.map_name] = map_name
+
+    RecentDestination\
+        .insert(user_ctx=user_ctx, map_id=map_id, node_id=node_id, title=title, map_name=map_name or '')\
+        .on_conflict(conflict_target=[RecentDestination.user_ctx, RecentDestination.node_id], update=update)\
+        .execute()
+
+    kept = RecentDestination\
+        .select(RecentDestination.id)\
+        .where(RecentDestination.user_ctx == user_ctx)\
+        .order_by(RecentDestination.used_at.desc())\
+        .limit(RECENT_DESTINATIONS_LIMIT)
+
+    RecentDestination\
+        .delete()\
+        .where(RecentDestination.user_ctx == user_ctx)\
+        .where(RecentDestination.id.not_in(kept))\
+        .execute()
+
+
+def get_recent_destinations(user_ctx, limit: int) -> List[RecentDestination]:
+    return list(RecentDestination
+                .select()
+                .where(RecentDestination.user_ctx == user_ctx)
+                .order_by(RecentDestination.used_at.desc())
+                .limit(limit))
+
+
+def del_recent_destination(user_ctx, node_id: str):
+    RecentDestination.delete()\
+        .where(RecentDestination.user_ctx == user_ctx)\
+        .where(RecentDestination.node_id == node_id)\
+        .execute()
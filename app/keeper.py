@@ -0,0 +1,1331 @@
+# must be the first import, it starts the startup timer
+from utils.startup import startup_timer, warm_up_imports
+
+import os
+from enum import IntEnum
+import asyncio
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from telebot import asyncio_filters, types
+from telebot.asyncio_handler_backends import StatesGroup, State
+from telebot.asyncio_storage import StateMemoryStorage
+
+from app.logger import logger, stop_logging
+from app.api import login_to_rf, get_favorite_nodes, move_node, get_node, get_destination_node, \
+    forget_destination_node, destination_nodes, rf_clients
+from app.db import init_db, create_tables, close_db, check_db_health, pool_stats, get_or_create_context, del_context, \
+    create_node_context, get_node_context, update_node_context, get_last_node_context, get_pending_node_contexts, \
+    claim_node_context, release_node_contexts, NodeContextClaimedException, RecentDestination, add_recent_destination, \
+    get_recent_destinations, del_recent_destination
+from app.lifecycle import Lifecycle
+from auto_save import AutoSaveQueue
+from bulk_save import save_pending
+from content_handler import ContentHandler
+from messages import Messages
+from app.tenants import Tenant, load_tenants
+from utils.bot import CallbackResponse, CurrentBot, LoggerMiddleware, GatedAsyncTeleBot
+from utils.admission import AdmissionController, BusyException
+from utils.bot_api import use_bot_api_server
+from utils.cache import TTLCache
+from utils.callbacks import CallbackRouter, encode_callback
+from utils.favorites import FavoritesSnapshot, FavoritesPage, destination_label
+from utils.html import node_title_to_text
+from utils.images import image_preprocessor
+from utils.preview import close_preview_session, previews
+from utils.snapshot import CacheSnapshot
+from utils.rf_links import link_to_node
+
+if TYPE_CHECKING:
+    from rf_api_client.models.nodes_api_models import NodeDto
+
+
+startup_timer.mark('imports')
+
+logger.info('RedForester Keeper bot started')
+
+
+use_bot_api_server()
+
+tenants = load_tenants()
+
+# the handlers below call the bot which has received the update
+bot = CurrentBot()
+
+
+# Heroku sends SIGKILL 30 seconds after SIGTERM
+lifecycle = Lifecycle(drain_timeout=float(os.getenv('RF_KEEPER_DRAIN_TIMEOUT', '25')))
+
+
+admission = AdmissionController(
+    user_concurrency=int(os.getenv('RF_KEEPER_USER_CONCURRENCY', '2')),
+    global_concurrency=int(os.getenv('RF_KEEPER_GLOBAL_CONCURRENCY', '20')),
+    user_queue=int(os.getenv('RF_KEEPER_USER_QUEUE', '10')),
+    global_queue=int(os.getenv('RF_KEEPER_GLOBAL_QUEUE', '200')),
+    user_rate=float(os.getenv('RF_KEEPER_USER_RATE', '60')),
+    user_burst=int(os.getenv('RF_KEEPER_USER_BURST', '30')),
+)
+
+
+AUTO_SAVE_DELAY = float(os.getenv('RF_KEEPER_AUTO_SAVE_DELAY', '2'))
+
+# tenant name -> auto-save queue of its bot
+auto_save_queues: Dict[str, AutoSaveQueue] = {}
+
+
+# concurrent media uploads of /saveall
+BULK_SAVE_UPLOADS = int(os.getenv('RF_KEEPER_BULK_SAVE_UPLOADS', '4'))
+
+
+HELP_MESSAGE = (
+    'Hi! I am RedForester Keeper bot.\n'
+    'I will save your messages to one of your favorite nodes.\n'
+)
+
+
+GH_LINK = 'https://github.com/RedForester/rf_keeper_telegram'
+
+
+COMMANDS = [
+    types.BotCommand('/start', 'Login to RedForester'),
+    types.BotCommand('/stop', 'Logout from RedForester'),
+    types.BotCommand('/autosave', 'Save messages without asking for the destination'),
+    types.BotCommand('/saveall', 'Save all the messages waiting for the destination'),
+    types.BotCommand('/cancel', 'Cancel the current action'),
+    types.BotCommand('/help', 'Show the help message'),
+]
+
+
+async def init_bot(tenant_bot: GatedAsyncTeleBot):
+    logger.info(f'Update bot info of {tenant_bot.tenant.name}')
+    await tenant_bot.set_my_commands(COMMANDS)
+
+
+class BotState(StatesGroup):
+    get_username = State()
+    get_password = State()
+    search_favorites = State()
+
+
+async def help_(message):
+    await bot.reply_to(
+        message,
+        f'{HELP_MESSAGE}\n'
+        f'<a href="{GH_LINK}">Link to bot source code</a>'
+    )
+
+
+async def start(message):
+    chat_id, ctx = get_or_create_context(message)
+
+    if ctx.is_authorized:
+        return await bot.reply_to(message, 'We\'ve already started. To logout from your account type /stop')
+
+    await bot.reply_to(
+        message,
+        f'{HELP_MESSAGE}\n'
+        'Let\'s start, type your username (email) for your RedForester account or /cancel:'
+    )
+
+    await bot.set_state(message.from_user.id, BotState.get_username, message.chat.id)
+
+
+async def stop(message):
+    del_context(message)
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    await bot.reply_to(message, 'Session has been terminated\n\nType /start to login again')
+
+
+def auto_save_status(ctx) -> str:
+    if not ctx.auto_save:
+        return Messages.auto_save_off
+
+    if ctx.auto_save_node_id:
+        return Messages.auto_save_to_node.format(destination_url=link_to_node(ctx.auto_save_map_id, ctx.auto_save_node_id))
+
+    return Messages.auto_save_to_last
+
+
+async def auto_save(message):
+    chat_id, ctx = get_or_create_context(message)
+
+    if not ctx.is_authorized:
+        return await bot.reply_to(message, Messages.no_start_error)
+
+    await bot.reply_to(message, auto_save_status(ctx), reply_markup=Keyboards.auto_save(ctx.auto_save))
+
+
+async def save_all(message):
+    chat_id, ctx = get_or_create_context(message)
+
+    if not ctx.is_authorized:
+        return await bot.reply_to(message, Messages.no_start_error)
+
+    pending_count = len(get_pending_node_contexts(ctx))
+
+    if not pending_count:
+        return await bot.reply_to(message, Messages.no_pending_messages)
+
+    await bot.reply_to(message, Messages.save_all_request.format(count=pending_count), reply_markup=Keyboards.save_all())
+
+
+async def cancel(message):
+    state = await bot.get_state(message.from_user.id, message.chat.id)
+
+    if not state:
+        await bot.reply_to(message, 'Nothing to cancel')
+    else:
+        await bot.reply_to(message, 'Action was canceled. Type /start to repeat')
+        await bot.delete_state(message.from_user.id, message.chat.id)
+
+
+async def start_get_username(message):
+    chat_id, ctx = get_or_create_context(message)
+    ctx.username = message.text.strip()
+    ctx.save()
+
+    await bot.send_message(
+        chat_id,
+        'And then type your password or /cancel:'
+    )
+
+    await bot.set_state(message.from_user.id, BotState.get_password, message.chat.id)
+
+
+async def start_get_password(message):
+    chat_id, ctx = get_or_create_context(message)
+
+    password = message.text.strip()
+
+    try:
+        rf_user = await login_to_rf(ctx.username, password)
+
+        # fixme
+        #  Yes, this is extremely bad to store unhashed password, but I have no choice for now.
+        #  If you really concern - self host this bot.
+        #  Meanwhile I am trying to create better solution.
+        ctx.password = password
+        ctx.is_authorized = True
+        ctx.save()
+
+        await bot.send_message(
+            chat_id,
+            f'Hi {rf_user.name} {rf_user.surname}, we are ready to go!\n\n'
+            f'Send me messages and I will save them to RedForester'
+        )
+
+        await bot.delete_state(message.from_user.id, message.chat.id)
+
+    except Exception as e:
+        logger.exception(e)
+
+        await bot.send_message(
+            chat_id,
+            'Something went wrong.\nPlease try again or type /cancel\n\nType your username (email):'
+        )
+
+        await bot.set_state(message.from_user.id, BotState.get_username, message.chat.id)
+
+    finally:
+        await bot.delete_message(chat_id, message.message_id)
+
+
+async def search_favorites(message):
+    chat_id, ctx = get_or_create_context(message)
+
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        mode = data.get('favorites_mode')
+        favorites_message_id = data.get('favorites_message_id')
+
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    await bot.delete_message(chat_id, message.message_id)
+
+    snapshot = favorites_cache.get(favorites_key(chat_id))
+
+    if not ctx.is_authorized or not snapshot or mode not in FAVORITES_CALLBACKS:
+        return await bot.send_message(chat_id, Messages.favorites_search_expired)
+
+    snapshot.filter(message.text.strip())
+
+    await show_favorites(chat_id, favorites_message_id, snapshot, 0, FAVORITES_CALLBACKS[mode])
+
+
+class SaveMessageCallbacks(IntEnum):
+    save_request = 1
+    save_to_last = 2
+    save_to = 3
+    save_go_back = 4
+    save_page = 5
+    save_search = 6
+
+    move_request = 7
+    move_to = 8
+    move_go_back = 9
+    move_page = 10
+    move_search = 11
+
+    noop = 12
+
+    auto_save_to_last = 13
+    auto_save_request = 14
+    auto_save_to = 15
+    auto_save_go_back = 16
+    auto_save_page = 17
+    auto_save_search = 18
+    auto_save_off = 19
+
+    save_all_to_last = 20
+    save_all_request = 21
+    save_all_to = 22
+    save_all_go_back = 23
+    save_all_page = 24
+    save_all_search = 25
+
+
+# callback_data of the buttons sent before the compact encoding
+LEGACY_CALLBACKS = {
+    'save-node-request': (SaveMessageCallbacks.save_request, None),
+    'save-node-to-last': (SaveMessageCallbacks.save_to_last, None),
+    'save-node-to-': (SaveMessageCallbacks.save_to, str),
+    'save-node-go-back': (SaveMessageCallbacks.save_go_back, None),
+    'move-node-request': (SaveMessageCallbacks.move_request, None),
+    'move-node-to-': (SaveMessageCallbacks.move_to, str),
+    'move-node-go-back': (SaveMessageCallbacks.move_go_back, None),
+}
+
+
+callback_router = CallbackRouter(legacy=LEGACY_CALLBACKS)
+
+
+class FavoritesCallbacks(NamedTuple):
+    mode: str
+    node: SaveMessageCallbacks
+    page: SaveMessageCallbacks
+    search: SaveMessageCallbacks
+    go_back: SaveMessageCallbacks
+
+
+FAVORITES_CALLBACKS = {
+    'save': FavoritesCallbacks(
+        mode='save',
+        node=SaveMessageCallbacks.save_to,
+        page=SaveMessageCallbacks.save_page,
+        search=SaveMessageCallbacks.save_search,
+        go_back=SaveMessageCallbacks.save_go_back,
+    ),
+    'move': FavoritesCallbacks(
+        mode='move',
+        node=SaveMessageCallbacks.move_to,
+        page=SaveMessageCallbacks.move_page,
+        search=SaveMessageCallbacks.move_search,
+        go_back=SaveMessageCallbacks.move_go_back,
+    ),
+    'auto_save': FavoritesCallbacks(
+        mode='auto_save',
+        node=SaveMessageCallbacks.auto_save_to,
+        page=SaveMessageCallbacks.auto_save_page,
+        search=SaveMessageCallbacks.auto_save_search,
+        go_back=SaveMessageCallbacks.auto_save_go_back,
+    ),
+    'save_all': FavoritesCallbacks(
+        mode='save_all',
+        node=SaveMessageCallbacks.save_all_to,
+        page=SaveMessageCallbacks.save_all_page,
+        search=SaveMessageCallbacks.save_all_search,
+        go_back=SaveMessageCallbacks.save_all_go_back,
+    ),
+}
+
+
+FAVORITES_PAGE_SIZE = 8
+
+
+# (tenant name, chat id) -> favorites fetched by the last 'Save to ...' or 'Move to ...' request
+favorites_cache: TTLCache[FavoritesSnapshot] = TTLCache(ttl=600, max_size=1000)
+
+
+def favorites_key(chat_id):
+    return bot.tenant.name, chat_id
+
+
+# the caches are kept across the restarts if the path is set
+cache_snapshot = CacheSnapshot(os.getenv('RF_KEEPER_CACHE_SNAPSHOT', ''), logger=logger)
+cache_snapshot.register('favorites', favorites_cache)
+cache_snapshot.register('nodes', destination_nodes)
+cache_snapshot.register('previews', previews)
+
+
+# recent destinations shown right in the 'Save to' keyboard
+RECENT_DESTINATIONS_SHOWN = int(os.getenv('RF_KEEPER_RECENT_DESTINATIONS', '3'))
+
+
+class Keyboards:
+    @staticmethod
+    def empty():
+        return types.InlineKeyboardMarkup()
+
+    @staticmethod
+    def save_to(recent: Sequence[RecentDestination] = ()):
+        kbd = types.InlineKeyboardMarkup()
+
+        for destination in recent:
+            kbd.row(types.InlineKeyboardButton(
+                text=destination_label(destination.map_name, destination.title),
+                callback_data=encode_callback(SaveMessageCallbacks.save_to, destination.node_id)
+            ))
+
+        kbd.add(
+            types.InlineKeyboardButton(text='Save to last', callback_data=encode_callback(SaveMessageCallbacks.save_to_last)),
+            types.InlineKeyboardButton(
+                text='More favorites…' if recent else 'Save to ...',
+                callback_data=encode_callback(SaveMessageCallbacks.save_request)
+            ),
+        )
+
+        return kbd
+
+    @staticmethod
+    def move_to(url: str):
+        kbd = types.InlineKeyboardMarkup()
+        kbd.add(
+            types.InlineKeyboardButton(text='Open in the browser', url=url),
+            types.InlineKeyboardButton(text='Move to ...', callback_data=encode_callback(SaveMessageCallbacks.move_request)),
+        )
+
+        return kbd
+
+    @staticmethod
+    def auto_save(enabled: bool):
+        kbd = types.InlineKeyboardMarkup()
+        kbd.add(
+            types.InlineKeyboardButton(text='Save to last', callback_data=encode_callback(SaveMessageCallbacks.auto_save_to_last)),
+            types.InlineKeyboardButton(text='Save to ...', callback_data=encode_callback(SaveMessageCallbacks.auto_save_request)),
+        )
+
+        if enabled:
+            kbd.add(types.InlineKeyboardButton(text='Turn off', callback_data=encode_callback(SaveMessageCallbacks.auto_save_off)))
+
+        return kbd
+
+    @staticmethod
+    def save_all():
+        kbd = types.InlineKeyboardMarkup()
+        kbd.add(
+            types.InlineKeyboardButton(text='Save to last', callback_data=encode_callback(SaveMessageCallbacks.save_all_to_last)),
+            types.InlineKeyboardButton(text='Save to ...', callback_data=encode_callback(SaveMessageCallbacks.save_all_request)),
+        )
+
+        return kbd
+
+    @staticmethod
+    def favorites_list(page: FavoritesPage, query: Optional[str], callbacks: FavoritesCallbacks):
+        kbd = types.InlineKeyboardMarkup(row_width=1)
+
+        favorite_buttons = [types.InlineKeyboardButton(
+            text=entry.label,
+            callback_data=encode_callback(callbacks.node, entry.id)
+        ) for entry in page.entries]
+
+        kbd.add(*favorite_buttons)
+
+        if page.count > 1:
+            navigation = [types.InlineKeyboardButton(
+                text=f'{page.number + 1} / {page.count}',
+                callback_data=encode_callback(SaveMessageCallbacks.noop)
+            )]
+
+            if page.number > 0:
+                navigation.insert(0, types.InlineKeyboardButton(
+                    text='◀️', callback_data=encode_callback(callbacks.page, page.number - 1)
+                ))
+
+            if page.number < page.count - 1:
+                navigation.append(types.InlineKeyboardButton(
+                    text='▶️', callback_data=encode_callback(callbacks.page, page.number + 1)
+                ))
+
+            kbd.row(*navigation)
+
+        search_button = types.InlineKeyboardButton(
+            text=f'❌ Clear "{query}"' if query else '🔍 Search',
+            callback_data=encode_callback(callbacks.search)
+        )
+
+        back_button = types.InlineKeyboardButton(
+            text='🔙 Go Back',
+            callback_data=encode_callback(callbacks.go_back)
+        )
+
+        kbd.row(search_button, back_button)
+
+        return kbd
+
+
+def save_to_keyboard(ctx):
+    """
+    The recent destinations come from the database, the favorites are requested by 'More favorites…' only
+    """
+    return Keyboards.save_to(get_recent_destinations(ctx, RECENT_DESTINATIONS_SHOWN))
+
+
+def remember_destination(chat_id, ctx, node):
+    """
+    The labels are taken from the favorites if they are cached, otherwise the map name is left as it was
+    """
+    snapshot = favorites_cache.get(favorites_key(chat_id))
+    fav = next((fav for fav in snapshot.favorites if fav.id == node.id), None) if snapshot else None
+
+    try:
+        if fav:
+            add_recent_destination(ctx, node.map_id, node.id, node_title_to_text(fav.id, fav.title), fav.map.name)
+        else:
+            add_recent_destination(ctx, node.map_id, node.id, node_title_to_text(node.id, node.body.properties.global_.title))
+    except Exception as e:
+        logger.exception(e)
+
+
+# Edge cases:
+#  [x] The user might send messages and press buttons after /stop
+#  [x] The user might delete bot messages (no code required)
+#  [x] node_ctx might be None for existing messages after user logout
+#  [-] 'Move to ...' states that the node is not found or the user does not have access to it, even if the node exists
+#  [x] The user has no previously saved nodes
+#  [x] Last saved node has been moved or deleted and the user press 'Save to last' button
+#  [x] Last saved node has been deleted
+#  [x] 'Save to...' list contains nodes that have been deleted and the user has selected one of them
+#  [x] The incoming message has been deleted before the user saved it (no code required)
+#  [x] 'Move to...' list contains nodes that have been deleted and the user has selected one of them
+#  [x] If created node has been deleted while the user selects destination node
+#       both actions ('Move to...' and 'Go back') should handle this state normally
+#  [-] If Created node has been deleted immediately after creation. 'Move to ...' should throw an error
+#       on the first interaction
+
+
+async def main_handler(message):
+    chat_id, ctx = get_or_create_context(message)
+
+    if not ctx.is_authorized:
+        return await bot.reply_to(message, Messages.no_start_error)
+
+    if not ContentHandler.is_supported(message):
+        return await bot.reply_to(message, Messages.unsupported_type_error)
+
+    if not admission.take(chat_id):
+        bot.tenant.count('rejected')
+
+        # a single reply to the whole burst of the rejected messages
+        if admission.rejected_count(chat_id) == 1:
+            await bot.reply_to(message, Messages.busy)
+
+        return
+
+    if ctx.auto_save:
+        return auto_save_queues[bot.tenant.name].add(message)
+
+    reply = await bot.reply_to(
+        message,
+        Messages.select_action,
+        reply_markup=save_to_keyboard(ctx)
+    )
+
+    create_node_context(ctx, message, reply)
+
+
+async def show_favorites(chat_id, message_id, snapshot: FavoritesSnapshot, page_number: int, callbacks: FavoritesCallbacks):
+    kbd = Keyboards.favorites_list(
+        snapshot.page(page_number, FAVORITES_PAGE_SIZE),
+        snapshot.query,
+        callbacks
+    )
+
+    await bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=message_id,
+        reply_markup=kbd
+    )
+
+
+async def request_favorites_callback(query, callbacks: FavoritesCallbacks, page_number: int = 0):
+    response = CallbackResponse(bot, query)
+
+    bot_message = query.message
+
+    chat_id, ctx = get_or_create_context(query.message.reply_to_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    # todo check if node has been deleted
+
+    try:
+        # todo filter out node links or use their sources as destination nodes
+        async with admission.slot(chat_id):
+            favorites = await get_favorite_nodes(ctx)
+
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        return await response.error(Messages.get_favorites_error)
+
+    snapshot = FavoritesSnapshot(favorites)
+    favorites_cache.set(favorites_key(chat_id), snapshot)
+
+    await show_favorites(chat_id, bot_message.message_id, snapshot, page_number, callbacks)
+
+
+async def favorites_page_callback(query, callbacks: FavoritesCallbacks, page_number: int):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message.reply_to_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    snapshot = favorites_cache.get(favorites_key(chat_id))
+
+    if not snapshot:
+        await request_favorites_callback(query, callbacks, page_number)
+        return await response.ok()
+
+    await show_favorites(chat_id, query.message.message_id, snapshot, page_number, callbacks)
+
+    await response.ok()
+
+
+async def favorites_search_callback(query, callbacks: FavoritesCallbacks):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message.reply_to_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    snapshot = favorites_cache.get(favorites_key(chat_id))
+
+    if not snapshot:
+        await request_favorites_callback(query, callbacks)
+        return await response.ok()
+
+    if snapshot.query:
+        snapshot.filter(None)
+        await show_favorites(chat_id, query.message.message_id, snapshot, 0, callbacks)
+        return await response.ok()
+
+    await bot.set_state(query.from_user.id, BotState.search_favorites, chat_id)
+    await bot.add_data(
+        query.from_user.id,
+        chat_id,
+        favorites_mode=callbacks.mode,
+        favorites_message_id=query.message.message_id
+    )
+
+    await response.notification(Messages.type_favorites_search)
+
+
+async def create_node_callback(query, map_id: str, parent_id: str):
+    bot_message = query.message
+    user_message = bot_message.reply_to_message
+
+    chat_id, ctx = get_or_create_context(user_message)
+
+    # NodeContextClaimedException if the message is being saved by /saveall, the auto-save or a double tap
+    node_ctx = claim_node_context(ctx, user_message)
+
+    try:
+        async with admission.slot(chat_id):
+            node = await ContentHandler(bot).save(ctx, map_id, parent_id, user_message)
+    except BusyException:
+        bot.tenant.count('busy')
+        raise
+    except Exception:
+        bot.tenant.count('save_failed')
+        raise
+    finally:
+        release_node_contexts([node_ctx.id])
+
+    bot.tenant.count('saved')
+
+    update_node_context(ctx, user_message, node.id)
+
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=bot_message.message_id,
+        text=Messages.node_created,
+        reply_markup=Keyboards.move_to(link_to_node(node.map_id, node.id))
+    )
+
+
+@callback_router.route(SaveMessageCallbacks.save_request)
+async def save_node_request(query):
+    await request_favorites_callback(query, FAVORITES_CALLBACKS['save'])
+
+    await CallbackResponse(bot, query).ok()
+
+
+@callback_router.route(SaveMessageCallbacks.save_page)
+async def save_node_page(query, page_number: int):
+    await favorites_page_callback(query, FAVORITES_CALLBACKS['save'], page_number)
+
+
+@callback_router.route(SaveMessageCallbacks.save_search)
+async def save_node_search(query):
+    await favorites_search_callback(query, FAVORITES_CALLBACKS['save'])
+
+
+@callback_router.route(SaveMessageCallbacks.save_to_last)
+async def save_node_to_last(query):
+    response = CallbackResponse(bot, query)
+
+    bot_message = query.message
+    user_message = bot_message.reply_to_message
+
+    chat_id, ctx = get_or_create_context(user_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    last_node_ctx = get_last_node_context(ctx)
+
+    if not last_node_ctx:
+        return await response.notification(Messages.no_last_saved_node)
+
+    try:
+        async with admission.slot(chat_id):
+            last_node = await get_node(ctx, last_node_ctx.node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=last_node_ctx.reply_id,
+            text=Messages.node_not_found,
+            reply_markup=Keyboards.empty()
+        )
+
+        last_node_ctx.delete_instance()
+
+        return await response.notification(Messages.last_saved_node_not_found)
+
+    try:
+        await create_node_callback(query, last_node.map_id, last_node.parent)
+    except BusyException:
+        return await response.notification(Messages.busy)
+    except NodeContextClaimedException:
+        return await response.notification(Messages.save_in_progress)
+    except Exception as e:
+        logger.exception(e)
+
+        destination_url = link_to_node(last_node.map_id, last_node.parent)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.node_create_error.format(destination_url=destination_url),
+        )
+
+    await response.ok()
+
+
+@callback_router.route(SaveMessageCallbacks.save_to)
+async def save_node_to(query, selected_node_id: str):
+    response = CallbackResponse(bot, query)
+
+    bot_message = query.message
+    user_message = bot_message.reply_to_message
+
+    chat_id, ctx = get_or_create_context(user_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    try:
+        async with admission.slot(chat_id):
+            destination_node = await get_destination_node(ctx, selected_node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        del_recent_destination(ctx, selected_node_id)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.destination_node_not_found,
+            reply_markup=save_to_keyboard(ctx)
+        )
+
+        return await response.ok()
+
+    try:
+        await create_node_callback(query, destination_node.map_id, destination_node.id)
+    except BusyException:
+        return await response.notification(Messages.busy)
+    except NodeContextClaimedException:
+        return await response.notification(Messages.save_in_progress)
+    except Exception as e:
+        logger.exception(e)
+
+        forget_destination_node(ctx, destination_node.id)
+
+        destination_url = link_to_node(destination_node.map_id, destination_node.id)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.node_create_error.format(destination_url=destination_url),
+            reply_markup=save_to_keyboard(ctx)
+        )
+    else:
+        remember_destination(chat_id, ctx, destination_node)
+
+    await response.ok()
+
+
+@callback_router.route(SaveMessageCallbacks.save_go_back)
+async def save_node_go_back(query):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message.reply_to_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    await bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=query.message.message_id,
+        reply_markup=save_to_keyboard(ctx)
+    )
+
+    await response.ok()
+
+
+@callback_router.route(SaveMessageCallbacks.move_request)
+async def move_node_request(query):
+    await request_favorites_callback(query, FAVORITES_CALLBACKS['move'])
+
+    await CallbackResponse(bot, query).ok()
+
+
+@callback_router.route(SaveMessageCallbacks.move_page)
+async def move_node_page(query, page_number: int):
+    await favorites_page_callback(query, FAVORITES_CALLBACKS['move'], page_number)
+
+
+@callback_router.route(SaveMessageCallbacks.move_search)
+async def move_node_search(query):
+    await favorites_search_callback(query, FAVORITES_CALLBACKS['move'])
+
+
+@callback_router.route(SaveMessageCallbacks.move_to)
+async def move_node_to(query, selected_node_id: str):
+    response = CallbackResponse(bot, query)
+
+    bot_message = query.message
+    user_message = bot_message.reply_to_message
+
+    chat_id, ctx = get_or_create_context(user_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    try:
+        node_ctx = get_node_context(ctx, user_message)
+
+        async with admission.slot(chat_id):
+            node = await get_node(ctx, node_ctx.node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.node_not_found,
+            reply_markup=Keyboards.empty()
+        )
+
+        return await response.ok()
+
+    node_url = link_to_node(node.map_id, node.id)
+
+    try:
+        async with admission.slot(chat_id):
+            destination_node = await get_destination_node(ctx, selected_node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.destination_node_not_found,
+            reply_markup=Keyboards.move_to(node_url)
+        )
+
+        return await response.ok()
+
+    try:
+        async with admission.slot(chat_id):
+            moved_node = await move_node(ctx, node.id, destination_node.id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        forget_destination_node(ctx, destination_node.id)
+
+        destination_url = link_to_node(destination_node.map_id, destination_node.id)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.node_move_error.format(destination_url=destination_url),
+            reply_markup=Keyboards.move_to(node_url)
+        )
+
+        return await response.ok()
+
+    remember_destination(chat_id, ctx, destination_node)
+
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=bot_message.message_id,
+        text=Messages.node_moved,
+        reply_markup=Keyboards.move_to(link_to_node(moved_node.map_id, moved_node.id))
+    )
+
+    await response.ok()
+
+
+@callback_router.route(SaveMessageCallbacks.move_go_back)
+async def move_node_go_back(query):
+    response = CallbackResponse(bot, query)
+
+    bot_message = query.message
+    user_message = bot_message.reply_to_message
+
+    chat_id, ctx = get_or_create_context(user_message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    try:
+        node_ctx = get_node_context(ctx, user_message)
+
+        async with admission.slot(chat_id):
+            node = await get_node(ctx, node_ctx.node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=bot_message.message_id,
+            text=Messages.node_not_found,
+            reply_markup=Keyboards.empty()
+        )
+
+        return await response.ok()
+
+    await bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=bot_message.message_id,
+        reply_markup=Keyboards.move_to(link_to_node(node.map_id, node.id))
+    )
+
+    await response.ok()
+
+
+async def update_auto_save(query, enabled: bool, map_id: Optional[str] = None, node_id: Optional[str] = None):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    ctx.auto_save = enabled
+    ctx.auto_save_map_id = map_id
+    ctx.auto_save_node_id = node_id
+    ctx.save()
+
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=query.message.message_id,
+        text=auto_save_status(ctx),
+        reply_markup=Keyboards.empty()
+    )
+
+    await response.ok()
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_to_last)
+async def auto_save_to_last(query):
+    await update_auto_save(query, enabled=True)
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_off)
+async def auto_save_off(query):
+    await update_auto_save(query, enabled=False)
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_request)
+async def auto_save_request(query):
+    await request_favorites_callback(query, FAVORITES_CALLBACKS['auto_save'])
+
+    await CallbackResponse(bot, query).ok()
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_page)
+async def auto_save_page(query, page_number: int):
+    await favorites_page_callback(query, FAVORITES_CALLBACKS['auto_save'], page_number)
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_search)
+async def auto_save_search(query):
+    await favorites_search_callback(query, FAVORITES_CALLBACKS['auto_save'])
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_to)
+async def auto_save_to(query, selected_node_id: str):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    try:
+        async with admission.slot(chat_id):
+            destination_node = await get_destination_node(ctx, selected_node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        return await response.error(Messages.destination_node_not_found)
+
+    await update_auto_save(query, enabled=True, map_id=destination_node.map_id, node_id=destination_node.id)
+
+
+@callback_router.route(SaveMessageCallbacks.auto_save_go_back)
+async def auto_save_go_back(query):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    await bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=query.message.message_id,
+        reply_markup=Keyboards.auto_save(ctx.auto_save)
+    )
+
+    await response.ok()
+
+
+async def save_all_callback(query, map_id: str, parent_id: str):
+    chat_id, ctx = get_or_create_context(query.message)
+    bot_message = query.message
+
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=bot_message.message_id,
+        text=Messages.save_all_started,
+        reply_markup=Keyboards.empty()
+    )
+
+    # each upload takes a slot, the messages which did not get one are left pending
+    saved, failed_count = await save_pending(bot, ctx, map_id, parent_id, admission, BULK_SAVE_UPLOADS)
+
+    bot.tenant.count('saved', len(saved))
+    bot.tenant.count('save_failed', failed_count)
+
+    text = Messages.messages_saved.format(count=len(saved), destination_url=link_to_node(map_id, parent_id))
+    if failed_count:
+        text += '\n' + Messages.messages_save_failed.format(count=failed_count)
+
+    await bot.edit_message_text(chat_id=chat_id, message_id=bot_message.message_id, text=text)
+
+    # the replies shared by several messages (auto-save status) are left as is
+    reply_counts = Counter(node_ctx.reply_id for node_ctx, _ in saved)
+    replies = [(node_ctx.reply_id, node) for node_ctx, node in saved if reply_counts[node_ctx.reply_id] == 1]
+
+    if replies:
+        lifecycle.create_background_task(update_saved_replies(chat_id, replies))
+
+
+# seconds between the edits of the replies after /saveall, Telegram allows about a message per second in a chat
+SAVED_REPLIES_EDIT_INTERVAL = 1.0
+
+
+async def update_saved_replies(chat_id: int, replies: List[Tuple[int, 'NodeDto']]):
+    """
+    Replaces the stale "where to save" keyboards of the saved messages, slowly, not to hit the flood limits
+    """
+    for reply_id, node in replies:
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=reply_id,
+                text=Messages.node_created,
+                reply_markup=Keyboards.move_to(link_to_node(node.map_id, node.id))
+            )
+        except Exception as e:
+            logger.exception(e)
+
+        await asyncio.sleep(SAVED_REPLIES_EDIT_INTERVAL)
+
+
+@callback_router.route(SaveMessageCallbacks.save_all_to_last)
+async def save_all_to_last(query):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    last_node_ctx = get_last_node_context(ctx)
+
+    if not last_node_ctx:
+        return await response.notification(Messages.no_last_saved_node)
+
+    try:
+        async with admission.slot(chat_id):
+            last_node = await get_node(ctx, last_node_ctx.node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        return await response.notification(Messages.last_saved_node_not_found)
+
+    await response.ok()
+
+    await save_all_callback(query, last_node.map_id, last_node.parent)
+
+
+@callback_router.route(SaveMessageCallbacks.save_all_request)
+async def save_all_request(query):
+    await request_favorites_callback(query, FAVORITES_CALLBACKS['save_all'])
+
+    await CallbackResponse(bot, query).ok()
+
+
+@callback_router.route(SaveMessageCallbacks.save_all_page)
+async def save_all_page(query, page_number: int):
+    await favorites_page_callback(query, FAVORITES_CALLBACKS['save_all'], page_number)
+
+
+@callback_router.route(SaveMessageCallbacks.save_all_search)
+async def save_all_search(query):
+    await favorites_search_callback(query, FAVORITES_CALLBACKS['save_all'])
+
+
+@callback_router.route(SaveMessageCallbacks.save_all_to)
+async def save_all_to(query, selected_node_id: str):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    try:
+        async with admission.slot(chat_id):
+            destination_node = await get_destination_node(ctx, selected_node_id)
+    except BusyException:
+        bot.tenant.count('busy')
+
+        return await response.notification(Messages.busy)
+    except Exception as e:
+        logger.exception(e)
+
+        return await response.error(Messages.destination_node_not_found)
+
+    await response.ok()
+
+    await save_all_callback(query, destination_node.map_id, destination_node.id)
+
+
+@callback_router.route(SaveMessageCallbacks.save_all_go_back)
+async def save_all_go_back(query):
+    response = CallbackResponse(bot, query)
+
+    chat_id, ctx = get_or_create_context(query.message)
+
+    if not ctx.is_authorized:
+        return await response.error(Messages.auth_error)
+
+    await bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=query.message.message_id,
+        reply_markup=Keyboards.save_all()
+    )
+
+    await response.ok()
+
+
+@callback_router.route(SaveMessageCallbacks.noop)
+async def noop(query):
+    await CallbackResponse(bot, query).ok()
+
+
+async def route_callback(query):
+    # the buttons are rate limited like the messages, most of them call RedForester
+    if not admission.take(query.message.chat.id):
+        bot.tenant.count('rejected')
+
+        return await CallbackResponse(bot, query).notification(Messages.busy)
+
+    if not await callback_router.dispatch(query):
+        logger.warning(f'Unknown callback data: {query.data}')
+
+        await CallbackResponse(bot, query).ok()
+
+
+# seconds between the database health checks
+DB_HEALTH_INTERVAL = float(os.getenv('RF_KEEPER_DB_HEALTH_INTERVAL', '60'))
+
+
+async def check_db_health_periodically():
+    while True:
+        await asyncio.sleep(DB_HEALTH_INTERVAL)
+
+        try:
+            check_db_health()
+        except Exception as e:
+            logger.exception(e)
+
+
+# seconds between the tenant metrics reports
+METRICS_INTERVAL = float(os.getenv('RF_KEEPER_METRICS_INTERVAL', '300'))
+
+
+def log_metrics():
+    for tenant in tenants:
+        logger.info(tenant.metrics_report())
+
+    stats = pool_stats()
+    if stats:
+        logger.info(f'Database connections: {stats["in_use"]} in use, {stats["idle"]} idle, {stats["max"]} max')
+
+
+async def log_metrics_periodically():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        log_metrics()
+
+
+def register_handlers(tenant_bot: GatedAsyncTeleBot):
+    """
+    The order matters, the first matching handler is called
+    """
+    tenant_bot.add_custom_filter(asyncio_filters.StateFilter(tenant_bot))
+    tenant_bot.setup_middleware(LoggerMiddleware(logger))
+
+    tenant_bot.register_message_handler(help_, commands=['help'])
+    tenant_bot.register_message_handler(start, commands=['start'])
+    tenant_bot.register_message_handler(stop, commands=['stop'])
+    tenant_bot.register_message_handler(auto_save, commands=['autosave'])
+    tenant_bot.register_message_handler(save_all, commands=['saveall'])
+    tenant_bot.register_message_handler(cancel, state='*', commands=['cancel'])
+    tenant_bot.register_message_handler(start_get_username, state=BotState.get_username)
+    tenant_bot.register_message_handler(start_get_password, state=BotState.get_password)
+    tenant_bot.register_message_handler(search_favorites, state=BotState.search_favorites)
+    tenant_bot.register_message_handler(main_handler, func=lambda m: True, content_types=ContentHandler.ALL_TYPES)
+    tenant_bot.register_callback_query_handler(route_callback, func=lambda query: True)
+
+
+def create_bot(tenant: Tenant) -> GatedAsyncTeleBot:
+    # the states are keyed by the chat and the user only, the default storage is shared by all the bots
+    tenant_bot = GatedAsyncTeleBot(
+        token=tenant.token,
+        parse_mode='HTML',
+        state_storage=StateMemoryStorage(),
+        logger=logger,
+        tenant=tenant,
+    )
+    register_handlers(tenant_bot)
+
+    auto_save_queues[tenant.name] = AutoSaveQueue(tenant_bot, delay=AUTO_SAVE_DELAY, admission=admission)
+
+    return tenant_bot
+
+
+async def wait_for_startup(bots: List[GatedAsyncTeleBot]):
+    await asyncio.gather(*[tenant_bot.startup_complete() for tenant_bot in bots])
+    startup_timer.ready(logger)
+
+
+async def run_bot():
+    bots = [create_bot(tenant) for tenant in tenants]
+
+    for queue in auto_save_queues.values():
+        lifecycle.on_stop(queue.flush_now)
+
+    # the HTTP session of telebot is shared by all the bots
+    lifecycle.on_shutdown(bots[0].close_session)
+    lifecycle.on_shutdown(close_preview_session)
+    lifecycle.on_shutdown(rf_clients.close)
+    lifecycle.on_shutdown(close_db)
+    lifecycle.on_shutdown(cache_snapshot.save)
+    lifecycle.on_shutdown(image_preprocessor.shutdown)
+
+    loop = asyncio.get_event_loop()
+
+    # The polling starts right away, the updates are held until the tables are checked.
+    # Everything else is not required to handle the updates.
+    tables_task = loop.run_in_executor(None, create_tables)
+
+    for tenant_bot in bots:
+        tenant_bot.hold_updates_until(tables_task)
+        lifecycle.create_background_task(init_bot(tenant_bot))
+
+    lifecycle.create_background_task(loop.run_in_executor(None, warm_up_imports))
+    lifecycle.create_background_task(wait_for_startup(bots))
+    lifecycle.create_background_task(check_db_health_periodically())
+    lifecycle.create_background_task(log_metrics_periodically())
+    lifecycle.create_background_task(cache_snapshot.load())
+    lifecycle.on_shutdown(log_metrics)
+
+    logger.info(f'Starting the polling of {len(bots)} bot(s)')
+    startup_timer.mark('polling')
+    await lifecycle.run(asyncio.gather(*[tenant_bot.infinity_polling() for tenant_bot in bots]))
+
+
+def main():
+    init_db()
+
+    asyncio.run(run_bot())
+
+    stop_logging()
@@ -0,0 +1,128 @@
+import asyncio
+import signal
+from typing import Awaitable, Callable, List, Optional, Set, Union
+
+from app.logger import logger
+
+Hook = Callable[[], Union[None, Awaitable[None]]]
+
+
+class Lifecycle:
+    """
+    Runs the bot until SIGTERM/SIGINT, then shuts it down in the following order:
+     1. stop fetching new updates
+     2. call 'on_stop' hooks (flush the batched work, so it becomes in-flight)
+     3. wait for in-flight tasks until the drain timeout expires, cancel the rest
+     4. cancel background tasks
+     5. call 'on_shutdown' hooks (persist caches, close connections)
+    """
+
+    def __init__(self, drain_timeout: float):
+        self._drain_timeout = drain_timeout
+        self._stop_hooks: List[Hook] = []
+        self._shutdown_hooks: List[Hook] = []
+        self._background: Set[asyncio.Task] = set()
+        self._stop_requested: Optional[asyncio.Event] = None
+
+    def on_stop(self, hook: Hook) -> Hook:
+        self._stop_hooks.append(hook)
+        return hook
+
+    def on_shutdown(self, hook: Hook) -> Hook:
+        self._shutdown_hooks.append(hook)
+        return hook
+
+    def create_background_task(self, coro: Awaitable) -> asyncio.Task:
+        """
+        Background tasks live until the shutdown and are not awaited while draining
+        """
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+        return task
+
+    def _background_done(self, task: asyncio.Task):
+        self._background.discard(task)
+
+        if not task.cancelled() and task.exception():
+            logger.error(task.exception(), exc_info=task.exception())
+
+    def request_stop(self):
+        if self._stop_requested and not self._stop_requested.is_set():
+            logger.info('Stop requested')
+            self._stop_requested.set()
+
+    def _install_signal_handlers(self):
+        loop = asyncio.get_event_loop()
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.request_stop)
+
+    async def run(self, polling: Awaitable):
+        self._stop_requested = asyncio.Event()
+        self._install_signal_handlers()
+
+        polling_task = asyncio.ensure_future(polling)
+        stop_task = asyncio.ensure_future(self._stop_requested.wait())
+
+        await asyncio.wait([polling_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+        logger.info('Stop polling')
+        stop_task.cancel()
+        polling_task.cancel()
+        await asyncio.gather(polling_task, stop_task, return_exceptions=True)
+
+        await self._call_hooks(self._stop_hooks)
+        await self._drain()
+        await self._cancel_background()
+        await self._call_hooks(self._shutdown_hooks)
+
+        logger.info('Shutdown complete')
+
+    def _in_flight(self) -> Set[asyncio.Task]:
+        current = asyncio.current_task()
+        return {task for task in asyncio.all_tasks() if task is not current and task not in self._background}
+
+    async def _drain(self):
+        """
+        Waits for the in-flight tasks, and for the tasks they start meanwhile (e.g. the last auto-save flushes)
+        """
+        in_flight = self._in_flight()
+
+        if not in_flight:
+            return
+
+        logger.info(f'Waiting for {len(in_flight)} in-flight tasks')
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self._drain_timeout
+
+        while in_flight and loop.time() < deadline:
+            await asyncio.wait(in_flight, timeout=deadline - loop.time())
+            in_flight = self._in_flight()
+
+        if in_flight:
+            logger.warning(f'{len(in_flight)} in-flight tasks did not finish in {self._drain_timeout}s, cancelling')
+
+            for task in in_flight:
+                task.cancel()
+
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def _cancel_background(self):
+        tasks = list(self._background)
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def _call_hooks(hooks: List[Hook]):
+        for hook in hooks:
+            try:
+                result = hook()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.exception(e)
@@ -1,6 +1,160 @@
+import atexit
+import json
 import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
-logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s: %(message)s'
+
+# 'sync' writes records on the calling thread, 'queue' hands them to a listener thread
+LOG_MODE = os.getenv('RF_KEEPER_LOG_MODE', 'sync')
+
+# 'text' or 'json'
+LOG_OUTPUT = os.getenv('RF_KEEPER_LOG_OUTPUT', 'text')
+
+# seconds to suppress repeated tracebacks of the same exception, 0 disables suppression
+LOG_DEDUP_WINDOW = float(os.getenv('RF_KEEPER_LOG_DEDUP_WINDOW', '60'))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, the traceback (if any) goes to the 'exception' key
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DuplicateExceptionFilter(logging.Filter):
+    """
+    Keeps one traceback of the same exception (type and raising line) per window,
+    the other records are logged without it. The first record after the window reports how many tracebacks
+    have been suppressed.
+    """
+
+    MAX_TRACKED = 1024
+
+    def __init__(self, window: float):
+        super().__init__()
+        self._window = window
+        self._seen = {}  # signature -> [window start, suppressed count]
+
+    @staticmethod
+    def _signature(exc_info):
+        exc_type, _, tb = exc_info
+
+        if tb is None:
+            return (exc_type,)
+
+        # the source lines are not needed, unlike traceback.extract_tb this does not read the files
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+
+        return exc_type, tb.tb_frame.f_code.co_filename, tb.tb_lineno
+
+    def _forget_expired(self, now: float):
+        self._seen = {
+            signature: seen for signature, seen in self._seen.items()
+            if now - seen[0] < self._window
+        }
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not record.exc_info or not record.exc_info[0]:
+            return True
+
+        now = time.monotonic()
+        signature = self._signature(record.exc_info)
+        seen = self._seen.get(signature)
+
+        if seen and now - seen[0] < self._window:
+            seen[1] += 1
+            record.msg = f'{record.getMessage()} (traceback suppressed)'
+            record.args = None
+            record.exc_info = None
+            record.exc_text = None
+            return True
+
+        if seen and seen[1]:
+            record.msg = f'{record.getMessage()} (suppressed {seen[1]} similar tracebacks)'
+            record.args = None
+
+        if len(self._seen) >= self.MAX_TRACKED:
+            self._forget_expired(now)
+
+        self._seen[signature] = [now, 0]
+
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Unlike the stock QueueHandler, does not format the record (and its traceback) on the calling thread,
+    the listener thread does it
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_listener: Optional[QueueListener] = None
+
+
+def _create_formatter() -> logging.Formatter:
+    if LOG_OUTPUT == 'json':
+        return JsonFormatter()
+
+    return logging.Formatter(LOG_FORMAT)
+
+
+def setup_logging():
+    global _listener
+
+    output_handler = logging.StreamHandler()
+    output_handler.setFormatter(_create_formatter())
+
+    if LOG_MODE == 'queue':
+        entry_handler = _DeferredQueueHandler(queue.SimpleQueue())
+        _listener = QueueListener(entry_handler.queue, output_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+    else:
+        entry_handler = output_handler
+
+    if LOG_DEDUP_WINDOW > 0:
+        entry_handler.addFilter(DuplicateExceptionFilter(LOG_DEDUP_WINDOW))
+
+    logging.basicConfig(level=logging.WARNING, handlers=[entry_handler])
+
+
+def stop_logging():
+    """
+    Writes out queued records and stops the listener thread
+    """
+    global _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+setup_logging()
 
 logger = logging.getLogger('bot')
 logger.setLevel(logging.INFO)
@@ -3,6 +3,8 @@ class Messages:
     no_start_error = 'You have to /start first'
     unsupported_type_error = 'Unsupported message type'
     get_favorites_error = 'Can not get favorites list'
+    type_favorites_search = 'Type a part of the map name or the node title'
+    favorites_search_expired = 'The favorites list is outdated, please press "Save to ..." or "Move to ..." again'
     select_action = 'Select the action:'
     no_last_saved_node = 'You have no last saved node'
     last_saved_node_not_found = 'Last saved node not found, please select the new node'
@@ -12,3 +14,15 @@ class Messages:
     node_create_error = 'Please check if you have access to the <a href="{destination_url}">destination node</a> and try again'
     node_moved = 'Node has been moved'
     node_move_error = 'Please check if you have access to the <a href="{destination_url}">destination node</a> and try again'
+    auto_save_off = 'Auto-save is off, I will ask where to save every message'
+    auto_save_to_last = 'Auto-save is on, messages are saved next to the last saved node'
+    auto_save_to_node = 'Auto-save is on, messages are saved to the <a href="{destination_url}">selected node</a>'
+    auto_save_started = 'Saving {count} message(s)...'
+    messages_saved = '{count} message(s) saved to the <a href="{destination_url}">destination node</a>'
+    messages_save_failed = '{count} message(s) could not be saved'
+    auto_save_destination_not_found = 'Auto-save destination not found or you have no access to it, please check /autosave'
+    no_pending_messages = 'There are no messages waiting for the destination'
+    save_all_request = '{count} message(s) are waiting for the destination, where to save them?'
+    save_all_started = 'Saving the messages...'
+    busy = 'Too many messages are being saved right now, please try again in a minute'
+    save_in_progress = 'This message is already being saved'
@@ -0,0 +1,55 @@
+from uuid import uuid4
+
+from aiohttp import BasicAuth, ClientSession, ClientTimeout, TCPConnector
+from rf_api_client import RfApiClient
+from rf_api_client.api.base_api import ApiContext
+from rf_api_client.api.comments_api import CommentsApi
+from rf_api_client.api.files_api import FilesApi
+from rf_api_client.api.maps_api import MapsApi
+from rf_api_client.api.node_types_api import NodeTypesApi
+from rf_api_client.api.nodes_api import NodesApi
+from rf_api_client.api.notify_api import NotifyApi
+from rf_api_client.api.tags_api import TagsApi
+from rf_api_client.api.users_api import UsersApi
+from rf_api_client.rf_api_client import DEFAULT_RF_URL, UserAuth
+
+
+class SharedConnectorRfApiClient(RfApiClient):
+    """
+    RfApiClient on the connector shared by all the clients.
+    The stock one opens a connector of its own, so each client has its own connections to RedForester.
+    """
+
+    def __init__(self, *, auth: UserAuth, connector: TCPConnector, timeout: ClientTimeout):
+        # RfApiClient.__init__ is not called, it creates the session with the connector
+        self._context = ApiContext(
+            username=auth.username,
+            password=auth.password,
+            session_id=str(uuid4()),
+            base_url=DEFAULT_RF_URL,
+            read_timeout=timeout.total,
+        )
+
+        self._log_response_body = False
+
+        self._session = ClientSession(
+            connector=connector,
+            connector_owner=False,
+            auth=BasicAuth(self._context.username, self._context.password),
+            timeout=timeout,
+            headers={
+                'SessionId': self._context.session_id,
+                'Rf-Session-Id': self._context.session_id
+            },
+            trace_configs=[self.get_trace_config()],
+            raise_for_status=True
+        )
+
+        self.users = UsersApi(self._session, self._context)
+        self.maps = MapsApi(self._session, self._context)
+        self.types = NodeTypesApi(self._session, self._context)
+        self.nodes = NodesApi(self._session, self._context)
+        self.comments = CommentsApi(self._session, self._context)
+        self.notify = NotifyApi(self._session, self._context)
+        self.tags = TagsApi(self._session, self._context)
+        self.files = FilesApi(self._session, self._context)
@@ -0,0 +1,45 @@
+import os
+from collections import Counter
+from contextvars import ContextVar
+from typing import List, Optional
+
+
+class Tenant:
+    """
+    One of the bots running in the process. The database, the caches and the connections are shared,
+    the user contexts and the metrics are kept per tenant.
+    """
+
+    def __init__(self, token: str, primary: bool):
+        self.token = token
+
+        # the part of the token before the colon, it is the id of the bot
+        self.name = token.split(':', 1)[0]
+
+        # the user contexts of the primary bot are stored without the bot id, as they were before the other bots
+        self.bot_id: Optional[str] = None if primary else self.name
+
+        self.metrics: Counter = Counter()
+
+    def count(self, metric: str, value: int = 1):
+        self.metrics[metric] += value
+
+    def metrics_report(self) -> str:
+        metrics = ', '.join(f'{metric} {value}' for metric, value in sorted(self.metrics.items()))
+        return f'Tenant {self.name}: {metrics or "no activity"}'
+
+
+def load_tenants() -> List[Tenant]:
+    """
+    RF_KEEPER_TOKEN is the primary bot, RF_KEEPER_EXTRA_TOKENS are the comma-separated tokens of the others
+    """
+    extra_tokens = [token.strip() for token in os.getenv('RF_KEEPER_EXTRA_TOKENS', '').split(',') if token.strip()]
+
+    return [
+        Tenant(os.getenv('RF_KEEPER_TOKEN', ''), primary=True),
+        *[Tenant(token, primary=False) for token in extra_tokens],
+    ]
+
+
+# the tenant of the update being handled, set by the bot before the handlers are called
+current_tenant: ContextVar[Tenant] = ContextVar('current_tenant')
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable, Tuple
+
+from exceptions import AppException
+
+
+# seconds between the cleanups of the rate limits of the users who have stopped sending messages
+PRUNE_INTERVAL = 60
+
+
+class BusyException(AppException):
+    pass
+
+
+class AdmissionController:
+    """
+    Limits the work of each user and of the whole bot.
+    Incoming messages are rate limited per user. The saves run in slots: up to user_concurrency per user
+    and global_concurrency in total. The users waiting for a slot are served round-robin,
+    so a user with hundreds of messages does not delay the others.
+    If too many saves are waiting already, BusyException is raised right away.
+    """
+
+    def __init__(self, user_concurrency: int, global_concurrency: int, user_queue: int, global_queue: int,
+                 user_rate: float, user_burst: int):
+        self._user_concurrency = user_concurrency
+        self._global_concurrency = global_concurrency
+        self._user_queue = user_queue
+        self._global_queue = global_queue
+
+        # messages per minute, refilled continuously up to the burst
+        self._user_rate = user_rate / 60
+        self._user_burst = user_burst
+
+        self._in_flight: Dict[Hashable, int] = {}
+        self._total_in_flight = 0
+
+        # users in the round-robin order -> their saves waiting for a slot
+        self._waiting: 'OrderedDict[Hashable, Deque[asyncio.Future]]' = OrderedDict()
+
+        # user -> tokens, last refill time
+        self._buckets: Dict[Hashable, Tuple[float, float]] = {}
+
+        # user -> messages rejected since the last accepted one
+        self._rejected: Dict[Hashable, int] = {}
+
+        self._pruned_at = time.monotonic()
+
+    def take(self, user_id: Hashable) -> bool:
+        """
+        Counts the incoming message against the rate limit of the user, False if it should be rejected
+        """
+        now = time.monotonic()
+
+        if now - self._pruned_at >= PRUNE_INTERVAL:
+            self._prune(now)
+
+        tokens, updated = self._buckets.get(user_id, (self._user_burst, now))
+        tokens = min(self._user_burst, tokens + (now - updated) * self._user_rate)
+
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            self._rejected[user_id] = self._rejected.get(user_id, 0) + 1
+            return False
+
+        self._buckets[user_id] = (tokens - 1, now)
+        self._rejected.pop(user_id, None)
+
+        return True
+
+    def _prune(self, now: float):
+        """
+        Forgets the users whose buckets are full again, they are no different from the new ones
+        """
+        self._pruned_at = now
+
+        for user_id, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self._user_rate >= self._user_burst:
+                del self._buckets[user_id]
+                self._rejected.pop(user_id, None)
+
+    def rejected_count(self, user_id: Hashable) -> int:
+        return self._rejected.get(user_id, 0)
+
+    @property
+    def waiting_count(self) -> int:
+        return sum(len(queue) for queue in self._waiting.values())
+
+    @property
+    def in_flight_count(self) -> int:
+        return self._total_in_flight
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable):
+        await self._acquire(user_id)
+
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    async def _acquire(self, user_id: Hashable):
+        queue = self._waiting.get(user_id)
+
+        if queue and len(queue) >= self._user_queue or self.waiting_count >= self._global_queue:
+            raise BusyException()
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self._schedule()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot has been given right before the cancellation
+                self._release(user_id)
+            else:
+                self._remove_waiting(user_id, future)
+
+            raise
+
+    def _remove_waiting(self, user_id: Hashable, future: asyncio.Future):
+        queue = self._waiting.get(user_id)
+
+        if queue and future in queue:
+            queue.remove(future)
+
+            if not queue:
+                del self._waiting[user_id]
+
+    def _release(self, user_id: Hashable):
+        self._total_in_flight -= 1
+        self._in_flight[user_id] -= 1
+
+        if not self._in_flight[user_id]:
+            del self._in_flight[user_id]
+
+        self._schedule()
+
+    def _schedule(self):
+        while self._waiting and self._total_in_flight < self._global_concurrency:
+            for user_id, queue in self._waiting.items():
+                if self._in_flight.get(user_id, 0) < self._user_concurrency:
+                    break
+            else:
+                return  # every waiting user has all their slots taken
+
+            future = queue.popleft()
+
+            if queue:
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+
+            # the waiting task has been cancelled, it removes the future itself only once it runs again
+            if future.done():
+                continue
+
+            self._total_in_flight += 1
+            self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+
+            future.set_result(None)
@@ -1,5 +1,70 @@
+import asyncio
+from contextvars import ContextVar
+from typing import List
+
+from telebot.async_telebot import AsyncTeleBot
 from telebot.asyncio_handler_backends import BaseMiddleware
 
+from app.tenants import Tenant, current_tenant
+from utils.startup import startup_timer
+
+
+class GatedAsyncTeleBot(AsyncTeleBot):
+    """
+    Holds the updates until the critical startup tasks are done, so the polling may start before them.
+    The updates are handled in the context of the bot and its tenant, see CurrentBot.
+    """
+
+    def __init__(self, *args, logger, tenant: Tenant, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tenant = tenant
+        self._logger = logger
+        self._startup_tasks: List[asyncio.Future] = []
+
+    def hold_updates_until(self, task: asyncio.Future):
+        self._startup_tasks.append(task)
+
+    async def startup_complete(self):
+        while self._startup_tasks:
+            done, pending = await asyncio.wait(self._startup_tasks)
+            self._startup_tasks = [task for task in self._startup_tasks if task in pending]
+
+            for task in done:
+                if not task.cancelled() and task.exception():
+                    self._logger.error(task.exception(), exc_info=task.exception())
+
+    async def process_new_updates(self, updates):
+        # the handler tasks are created below, they inherit the context
+        use_bot(self)
+
+        if self._startup_tasks:
+            await self.startup_complete()
+
+        await super().process_new_updates(updates)
+
+        startup_timer.first_update_handled(self._logger)
+
+
+current_bot: ContextVar[GatedAsyncTeleBot] = ContextVar('current_bot')
+
+
+def use_bot(bot: GatedAsyncTeleBot):
+    """
+    Sets the bot of the current task and the tasks it creates
+    """
+    current_bot.set(bot)
+    current_tenant.set(bot.tenant)
+
+
+class CurrentBot:
+    """
+    The bot handling the current update. The handlers are shared by all the bots of the process,
+    they call the bot through this proxy.
+    """
+
+    def __getattr__(self, name):
+        return getattr(current_bot.get(), name)
+
 
 class LoggerMiddleware(BaseMiddleware):
     update_types = ['message']
@@ -9,6 +74,7 @@ class LoggerMiddleware(BaseMiddleware):
         self._logger = logger
 
     async def pre_process(self, message, data):
+        current_tenant.get().count('messages')
         self._logger.info(f'Incoming message from chat: {message.chat.id}')
 
     async def post_process(self, message, data, exception):
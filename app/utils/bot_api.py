@@ -0,0 +1,54 @@
+import os
+
+from exceptions import AppException
+
+# self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api) started with --local,
+# it gives files up to 2000 MB right on the disk instead of 20 MB through the download link
+BOT_API_URL = os.getenv('RF_KEEPER_BOT_API_URL')
+
+# the --dir of the server and the same directory as mounted to this app, if the paths differ
+BOT_API_DIR = os.getenv('RF_KEEPER_BOT_API_DIR')
+BOT_API_LOCAL_DIR = os.getenv('RF_KEEPER_BOT_API_LOCAL_DIR')
+
+
+class LocalFileNotAvailableException(AppException):
+    pass
+
+
+def use_bot_api_server():
+    """
+    Sends all the requests to RF_KEEPER_BOT_API_URL, if set
+    """
+    if not BOT_API_URL:
+        return
+
+    from telebot import asyncio_helper
+
+    url = BOT_API_URL.rstrip('/')
+    asyncio_helper.API_URL = url + '/bot{0}/{1}'
+    asyncio_helper.FILE_URL = url + '/file/bot{0}/{1}'
+
+
+def is_local_file(file_path: str) -> bool:
+    """
+    The server in the --local mode returns the absolute paths instead of the relative download links
+    """
+    return os.path.isabs(file_path)
+
+
+def local_file_path(file_path: str) -> str:
+    """
+    Path to the file received from the local server as seen by this app
+    """
+    if BOT_API_DIR and BOT_API_LOCAL_DIR:
+        relative_path = os.path.relpath(file_path, BOT_API_DIR)
+
+        if relative_path.startswith(os.pardir):
+            raise LocalFileNotAvailableException(f'{file_path} is outside of {BOT_API_DIR}')
+
+        file_path = os.path.join(BOT_API_LOCAL_DIR, relative_path)
+
+    if not os.path.isfile(file_path):
+        raise LocalFileNotAvailableException(f'{file_path} does not exist')
+
+    return file_path
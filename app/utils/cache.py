@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, List, Optional, Tuple, TypeVar
+
+V = TypeVar('V')
+
+
+class TTLCache(Generic[V]):
+    """
+    In-memory cache, entries expire after ttl seconds, the least recently set entry is evicted when full
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()  # key -> (expires at, value)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        return value
+
+    def set(self, key: Hashable, value: V):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def export(self) -> List[Tuple[Hashable, float, V]]:
+        """
+        The entries which are not expired yet, with the wall clock expiration time to survive the restart
+        """
+        now = time.monotonic()
+        offset = time.time() - now
+
+        return [(key, expires_at + offset, value) for key, (expires_at, value) in self._entries.items() if expires_at > now]
+
+    def restore(self, entries: List[Tuple[Hashable, float, V]]) -> int:
+        """
+        Adds the exported entries as the oldest ones, the expired entries and the keys set since the start are skipped.
+        Returns the count of the restored entries.
+        """
+        offset = time.monotonic() - time.time()
+        restored = 0
+
+        for key, expires_at, value in reversed(entries):
+            if key in self._entries or expires_at + offset < time.monotonic():
+                continue
+
+            self._entries[key] = (expires_at + offset, value)
+            self._entries.move_to_end(key, last=False)
+            restored += 1
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+        return restored
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LRUCache(Generic[V]):
+    """
+    In-memory cache of the max_size most recently used entries
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._entries: 'OrderedDict[Hashable, V]' = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        value = self._entries.get(key)
+
+        if value is not None:
+            self._entries.move_to_end(key)
+
+        return value
+
+    def set(self, key: Hashable, value: V):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
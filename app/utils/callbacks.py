@@ -0,0 +1,146 @@
+import base64
+import inspect
+import uuid
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+
+from exceptions import AppException
+
+# Telegram limits callback_data to 64 bytes
+MAX_CALLBACK_DATA_LENGTH = 64
+
+CALLBACK_VERSION = 1
+
+_UUID = 1
+_INT = 2
+_STR = 3
+
+CallbackArg = Union[str, int]
+CallbackHandler = Callable[..., Awaitable]
+
+
+class InvalidCallbackDataException(AppException):
+    pass
+
+
+def _encode_arg(arg: CallbackArg) -> bytes:
+    if isinstance(arg, int):
+        value = arg.to_bytes((arg.bit_length() + 7) // 8 or 1, 'big')
+        return bytes((_INT, len(value))) + value
+
+    try:
+        node_id = uuid.UUID(arg)
+        if str(node_id) == arg:
+            return bytes((_UUID,)) + node_id.bytes
+    except ValueError:
+        pass
+
+    value = arg.encode()
+    return bytes((_STR, len(value))) + value
+
+
+def encode_callback(action: int, *args: CallbackArg) -> str:
+    """
+    Packs the action code and the arguments as: version byte, action byte, tagged arguments; base64url without padding.
+    Node ids (uuid) take 17 bytes instead of 36.
+    """
+    data = bytes((CALLBACK_VERSION, action)) + b''.join(_encode_arg(arg) for arg in args)
+    encoded = base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    if len(encoded) > MAX_CALLBACK_DATA_LENGTH:
+        raise ValueError(f'Callback data is too long: {len(encoded)} bytes')
+
+    return encoded
+
+
+def decode_callback(encoded: str) -> Tuple[int, List[CallbackArg]]:
+    try:
+        data = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except ValueError:
+        raise InvalidCallbackDataException(encoded)
+
+    if len(data) < 2 or data[0] != CALLBACK_VERSION:
+        raise InvalidCallbackDataException(encoded)
+
+    action, args, position = data[1], [], 2
+
+    try:
+        while position < len(data):
+            tag = data[position]
+
+            if tag == _UUID:
+                args.append(str(uuid.UUID(bytes=data[position + 1:position + 17])))
+                position += 17
+            elif tag in (_INT, _STR):
+                length = data[position + 1]
+                value = data[position + 2:position + 2 + length]
+                args.append(int.from_bytes(value, 'big') if tag == _INT else value.decode())
+                position += 2 + length
+            else:
+                raise InvalidCallbackDataException(encoded)
+
+    except (IndexError, ValueError):
+        raise InvalidCallbackDataException(encoded)
+
+    return action, args
+
+
+class CallbackRouter:
+    """
+    Dispatches callback queries by the action code with a single table lookup.
+
+    Buttons sent before the compact encoding carry plain string data,
+    'legacy' maps such a string (or its prefix, followed by the argument) to the action.
+    """
+
+    def __init__(self, legacy: Dict[str, Tuple[int, type]]):
+        self._handlers: Dict[int, CallbackHandler] = {}
+        self._signatures: Dict[int, inspect.Signature] = {}
+        # longest prefixes first, so 'save-node-to-last' wins over 'save-node-to-'
+        self._legacy = sorted(legacy.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def route(self, action: int):
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            self._handlers[action] = handler
+            self._signatures[action] = inspect.signature(handler)
+            return handler
+
+        return decorator
+
+    def _decode_legacy(self, data: str) -> Tuple[int, List[CallbackArg]]:
+        for prefix, (action, arg_type) in self._legacy:
+            if data == prefix and arg_type is None:
+                return action, []
+
+            if arg_type is not None and data.startswith(prefix) and len(data) > len(prefix):
+                return action, [arg_type(data[len(prefix):])]
+
+        raise InvalidCallbackDataException(data)
+
+    def decode(self, data: str) -> Tuple[int, List[CallbackArg]]:
+        try:
+            return decode_callback(data)
+        except InvalidCallbackDataException:
+            return self._decode_legacy(data)
+
+    async def dispatch(self, query) -> bool:
+        """
+        Returns False if the query data is malformed, has no handler or does not fit its arguments
+        """
+        try:
+            action, args = self.decode(query.data or '')
+        except (InvalidCallbackDataException, ValueError):
+            return False
+
+        handler = self._handlers.get(action)
+
+        if not handler:
+            return False
+
+        try:
+            self._signatures[action].bind(query, *args)
+        except TypeError:
+            return False
+
+        await handler(query, *args)
+
+        return True
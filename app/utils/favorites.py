@@ -0,0 +1,118 @@
+import difflib
+import re
+from typing import Dict, List, NamedTuple, Optional, Set, TYPE_CHECKING
+
+from utils.html import node_title_to_text
+
+if TYPE_CHECKING:
+    from rf_api_client.models.tags_api_models import TaggedNodeDto
+
+
+WORD = re.compile(r'\w+')
+
+# longer words are indexed by their first characters only
+MAX_PREFIX_LENGTH = 24
+
+
+def _words(text: str) -> List[str]:
+    return WORD.findall(text.lower())
+
+
+def destination_label(map_name: str, title: str) -> str:
+    return f'{map_name} / {title}' if map_name else title
+
+
+def favorite_label(fav: 'TaggedNodeDto') -> str:
+    return destination_label(fav.map.name, node_title_to_text(fav.id, fav.title))
+
+
+class FavoriteEntry(NamedTuple):
+    id: str
+    label: str
+
+
+class FavoritesPage(NamedTuple):
+    entries: List[FavoriteEntry]
+    number: int
+    count: int
+
+
+class FavoritesIndex:
+    """
+    Searches favorites by the word prefixes of the map name and the node title.
+    If no word starts with some of the query words, the similar words are used instead.
+    """
+
+    def __init__(self, favorites: List['TaggedNodeDto']):
+        self._favorites = favorites
+        self._words: Dict[str, Set[int]] = {}
+        self._prefixes: Dict[str, Set[int]] = {}
+
+        for position, fav in enumerate(favorites):
+            for word in _words(favorite_label(fav)):
+                self._words.setdefault(word, set()).add(position)
+
+                for end in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(position)
+
+    def _similar(self, word: str) -> Set[int]:
+        positions = set()
+
+        for similar in difflib.get_close_matches(word, self._words.keys(), n=5, cutoff=0.75):
+            positions |= self._words[similar]
+
+        return positions
+
+    def search(self, query: str) -> List['TaggedNodeDto']:
+        positions = None
+
+        for word in _words(query):
+            matched = self._prefixes.get(word[:MAX_PREFIX_LENGTH]) or self._similar(word)
+            positions = matched if positions is None else positions & matched
+
+        if positions is None:
+            return self._favorites
+
+        return [self._favorites[position] for position in sorted(positions)]
+
+
+class FavoritesSnapshot:
+    """
+    Favorites list fetched once and then paginated and filtered locally.
+    The labels are rendered for the requested page only, the search index is built on the first search.
+    """
+
+    def __init__(self, favorites: List['TaggedNodeDto']):
+        self.favorites = [fav for fav in favorites if fav.title]
+        self.query: Optional[str] = None
+        self.results = self.favorites
+        self._index: Optional[FavoritesIndex] = None
+
+    def __getstate__(self):
+        # the index is not worth saving to the cache snapshot, it is rebuilt on the next search
+        return {**self.__dict__, '_index': None}
+
+    def filter(self, query: Optional[str]):
+        if not query:
+            self.query = None
+            self.results = self.favorites
+            return
+
+        if self._index is None:
+            self._index = FavoritesIndex(self.favorites)
+
+        self.query = query
+        self.results = self._index.search(query)
+
+    def page(self, number: int, size: int) -> FavoritesPage:
+        count = max(1, -(-len(self.results) // size))
+        number = min(max(number, 0), count - 1)
+
+        return FavoritesPage(
+            entries=[
+                FavoriteEntry(fav.id, favorite_label(fav))
+                for fav in self.results[number * size:(number + 1) * size]
+            ],
+            number=number,
+            count=count,
+        )
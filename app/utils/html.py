@@ -1,10 +1,20 @@
 import re
+from typing import TYPE_CHECKING
 
-from bs4 import BeautifulSoup, Tag
+from utils.cache import LRUCache
+from utils.file_guess import guess_file_type
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+
+def parse_html(html: str) -> 'BeautifulSoup':
+    from bs4 import BeautifulSoup  # imported on the first use
+
+    return BeautifulSoup(html, 'html.parser')
 
 
 # pre, code and strikethrough underline are ok
-from utils.file_guess import guess_file_type
 
 CUSTOM_SUBS = {
     'bold': '<strong>{text}</strong>',
@@ -24,7 +34,9 @@ def _fix_newlines(html: str) -> str:
     Input:  <strong>bold\n\n</strong>new line
     Output: <strong>bold</strong>\n\nnew line
     """
-    soup = BeautifulSoup(html, 'html.parser')
+    from bs4 import Tag
+
+    soup = parse_html(html)
 
     for children in soup.children:
         if isinstance(children, Tag) and not children.find():
@@ -45,7 +57,7 @@ def _wrap_line(html: str) -> str:
     if not html:
         return '<p><br></p>'
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = parse_html(html)
     # pre is already a block element, no need to wrap it
     if soup.find('pre'):
         return html
@@ -61,7 +73,7 @@ def _replace_zwsp_preview(html: str) -> str:
     A common Telegram trick to add the image to the text message is to wrap ZWSP characters with the link to the image.
     This function tries to find this type of link, extract it and append image tag to the bottom.
     """
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = parse_html(html)
 
     zwsp_preview = soup.find('a', string=ZWSP_STRING)
     if not zwsp_preview:
@@ -72,7 +84,7 @@ def _replace_zwsp_preview(html: str) -> str:
     href = zwsp_preview.attrs.get('href', '')
     file_type = guess_file_type(href)
     if file_type and file_type.startswith('image/'):
-        preview = soup.new_tag('img', src=href)  # todo download image and set width and height attrs
+        preview = soup.new_tag('img', src=href)  # width and height are set by utils.preview.enrich_html
         p = soup.new_tag('p')
         p.append(preview)
         soup.append(p)
@@ -87,14 +99,14 @@ def tg_html_to_rf_html(html: str) -> str:
 
     without_zwsp_link_html = _replace_zwsp_preview(wrapped_html)
 
-    # todo create preview for links to pages with og meta tags
+    # the link previews need the network, see utils.preview.enrich_html
 
     return without_zwsp_link_html
 
 
 # todo release as package
 def html_to_text(html: str, one_line: bool = False) -> str:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = parse_html(html)
 
     if not soup.find():
         return html  # plain text
@@ -105,3 +117,24 @@ def html_to_text(html: str, one_line: bool = False) -> str:
         return lines[0]
 
     return '\n'.join(lines)
+
+
+# (node id, title hash) -> plain text title
+_node_titles: LRUCache[str] = LRUCache(max_size=10000)
+
+
+def node_title_to_text(node_id: str, title: str) -> str:
+    """
+    Memoized html_to_text for node titles, titles without markup are returned as is without parsing
+    """
+    if '<' not in title:
+        return title
+
+    key = (node_id, hash(title))
+    text = _node_titles.get(key)
+
+    if text is None:
+        text = html_to_text(title)
+        _node_titles.set(key, text)
+
+    return text
@@ -0,0 +1,109 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional
+
+# the longer side of the uploaded images is reduced to that, 0 disables the preprocessing
+IMAGE_MAX_SIDE = int(os.getenv('RF_KEEPER_IMAGE_MAX_SIDE', '0'))
+
+# JPEG and WEBP quality of the recompressed images
+IMAGE_QUALITY = int(os.getenv('RF_KEEPER_IMAGE_QUALITY', '85'))
+
+IMAGE_WORKERS = int(os.getenv('RF_KEEPER_IMAGE_WORKERS', '2'))
+
+# larger files are uploaded as is, they are not worth loading into the memory
+IMAGE_MAX_BYTES = 50 * 1024 * 1024
+
+# the formats which can be saved back without losing anything but the metadata and the extra pixels
+SUPPORTED_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+
+class ProcessedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+
+
+def preprocess_image(data: bytes, max_side: int, quality: int, only_oversized: bool) -> Optional[ProcessedImage]:
+    """
+    Runs in the worker process. Applies the EXIF orientation, downscales the image to max_side,
+    and saves it again without the metadata. None if the image should be uploaded as is.
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    image_format = image.format
+
+    if image_format not in SUPPORTED_FORMATS or getattr(image, 'is_animated', False):
+        return None
+
+    oversized = max(image.size) > max_side
+    if only_oversized and not oversized:
+        return None
+
+    image = ImageOps.exif_transpose(image)
+
+    if oversized:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    if image_format == 'PNG':
+        image.save(output, format='PNG', optimize=True)
+    else:
+        image.save(output, format=image_format, quality=quality, optimize=True)
+
+    processed = output.getvalue()
+
+    # recompressed, but not smaller: the original is better
+    if not oversized and len(processed) >= len(data):
+        return ProcessedImage(data, *image.size)
+
+    return ProcessedImage(processed, *image.size)
+
+
+class ImagePreprocessor:
+    """
+    Moves the image processing to the process pool, so it does not block the event loop or hold the GIL
+    """
+
+    def __init__(self, max_side: int, quality: int, workers: int):
+        self._max_side = max_side
+        self._quality = quality
+        self._workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_side > 0
+
+    async def process(self, data: bytes, only_oversized: bool = False) -> Optional[ProcessedImage]:
+        if self._pool is None:
+            # the forked workers would inherit the event loop, the connections and the locks held by the other threads
+            self._pool = ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context('spawn'))
+
+        pool = self._pool
+
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                pool, preprocess_image, data, self._max_side, self._quality, only_oversized
+            )
+        except BrokenProcessPool:
+            # a worker has died, e.g. killed for the memory while decoding a huge image, the next call starts a new pool
+            if self._pool is pool:
+                self._pool = None
+                pool.shutdown(wait=False)
+
+            raise
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+
+image_preprocessor = ImagePreprocessor(IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_WORKERS)
@@ -0,0 +1,289 @@
+import asyncio
+import ipaddress
+import os
+import socket
+import struct
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+
+from utils.cache import TTLCache
+from utils.html import parse_html
+
+# the whole enrichment of one message, the save is not waiting longer than that
+PREVIEW_BUDGET = float(os.getenv('RF_KEEPER_PREVIEW_BUDGET', '1.5'))
+
+# only the beginning of the page or the image is downloaded
+PREVIEW_MAX_BYTES = int(os.getenv('RF_KEEPER_PREVIEW_MAX_BYTES', '32768'))
+
+# a single page download, it goes on in the background after PREVIEW_BUDGET to be cached for the next time
+PREVIEW_TIMEOUT = float(os.getenv('RF_KEEPER_PREVIEW_TIMEOUT', '5'))
+
+# comma-separated hosts which are fetched even if they are not public, e.g. the local stub for the tests
+PREVIEW_ALLOWED_HOSTS = {host.strip() for host in os.getenv('RF_KEEPER_PREVIEW_ALLOWED_HOSTS', '').split(',')
+                         if host.strip()}
+
+# links per message to look for the open graph tags
+PREVIEW_MAX_LINKS = 3
+
+PREVIEW_MAX_REDIRECTS = 3
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class LinkPreview(NamedTuple):
+    title: Optional[str] = None
+    description: Optional[str] = None
+    image: Optional[str] = None
+    image_size: Optional[Tuple[int, int]] = None
+
+
+# url -> preview, empty preview if the url has nothing to show
+previews: TTLCache[LinkPreview] = TTLCache(ttl=3600, max_size=5000)
+
+class PublicResolver(AbstractResolver):
+    """
+    Refuses the hosts resolved to the private, loopback or link-local addresses.
+    The check of the url is not enough: any name can point to 127.0.0.1 or to the metadata service.
+    """
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        hosts = await self._resolver.resolve(host, port, family)
+
+        if host not in PREVIEW_ALLOWED_HOSTS and not all(_is_public_address(h['host']) for h in hosts):
+            raise OSError(f'{host} is not a public host')
+
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, resolver=PublicResolver()),
+            timeout=aiohttp.ClientTimeout(total=PREVIEW_TIMEOUT),
+            headers={'User-Agent': 'Mozilla/5.0 (compatible; RedForesterKeeperBot)'},
+        )
+
+    return _session
+
+
+async def close_preview_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+def _is_public_address(address: str) -> bool:
+    try:
+        return ipaddress.ip_address(address).is_global
+    except ValueError:
+        return False
+
+
+def _is_public_url(url: str) -> bool:
+    """
+    Quick check before the download, the resolved addresses are checked by PublicResolver
+    """
+    parsed = urlparse(url)
+
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return False
+
+    if parsed.hostname in PREVIEW_ALLOWED_HOSTS:
+        return True
+
+    try:
+        return ipaddress.ip_address(parsed.hostname).is_global
+    except ValueError:
+        return parsed.hostname != 'localhost'
+
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Width and height from the PNG, GIF or JPEG header
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n') and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+
+    if data.startswith(b'\xff\xd8'):
+        position = 2
+
+        while position + 9 <= len(data):
+            if data[position] != 0xFF:
+                return None
+
+            marker = data[position + 1]
+            length = struct.unpack('>H', data[position + 2:position + 4])[0]
+
+            # start of frame markers, except DHT, JPG and DAC
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack('>HH', data[position + 5:position + 9])
+                return width, height
+
+            position += 2 + length
+
+    return None
+
+
+def _parse_open_graph(data: bytes, encoding: str) -> LinkPreview:
+    soup = parse_html(data.decode(encoding, errors='replace'))
+    tags: Dict[str, str] = {}
+
+    for meta in soup.find_all('meta'):
+        key = meta.get('property') or meta.get('name') or ''
+        if key.startswith('og:') and meta.get('content'):
+            tags.setdefault(key, meta['content'].strip())
+
+    return LinkPreview(
+        title=tags.get('og:title'),
+        description=tags.get('og:description'),
+        image=tags.get('og:image') if _is_public_url(tags.get('og:image', '')) else None,
+    )
+
+
+async def _download_head(url: str) -> Tuple[str, str, bytes]:
+    """
+    Content type, encoding and the first PREVIEW_MAX_BYTES of the response.
+    The redirects are followed here, so every hop is checked like the link itself.
+    """
+    for _ in range(PREVIEW_MAX_REDIRECTS + 1):
+        async with _get_session().get(url, headers={'Range': f'bytes=0-{PREVIEW_MAX_BYTES - 1}'},
+                                      allow_redirects=False) as resp:
+            if resp.status in REDIRECT_STATUSES and 'Location' in resp.headers:
+                url = urljoin(url, resp.headers['Location'])
+
+                if not _is_public_url(url):
+                    raise aiohttp.InvalidURL(url)
+
+                continue
+
+            resp.raise_for_status()
+
+            data = b''
+            while len(data) < PREVIEW_MAX_BYTES:
+                chunk = await resp.content.read(PREVIEW_MAX_BYTES - len(data))
+                if not chunk:
+                    break
+                data += chunk
+
+            return resp.content_type, resp.charset or 'utf-8', data
+
+    raise aiohttp.TooManyRedirects(resp.request_info, resp.history)
+
+
+async def get_preview(url: str) -> LinkPreview:
+    preview = previews.get(url)
+
+    if preview is not None:
+        return preview
+
+    try:
+        content_type, encoding, data = await _download_head(url)
+
+        if content_type.startswith('image/'):
+            preview = LinkPreview(image=url, image_size=image_size(data))
+        elif content_type in ('text/html', 'application/xhtml+xml'):
+            preview = _parse_open_graph(data, encoding)
+        else:
+            preview = LinkPreview()
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, LookupError):
+        preview = LinkPreview()
+
+    previews.set(url, preview)
+
+    return preview
+
+
+async def _enrich(html: str) -> str:
+    soup = parse_html(html)
+
+    # image from the ZWSP link (see _replace_zwsp_preview)
+    images = [img for img in soup.find_all('img') if not img.get('width') and _is_public_url(img.get('src', ''))]
+
+    links = []
+    for a in soup.find_all('a'):
+        href = a.get('href', '')
+        if _is_public_url(href) and href not in links and urlparse(href).hostname != 't.me':
+            links.append(href)
+
+    links = links[:PREVIEW_MAX_LINKS]
+
+    if not images and not links:
+        return html
+
+    results = await asyncio.gather(*[get_preview(img['src']) for img in images], *[get_preview(link) for link in links])
+    image_previews, link_previews = results[:len(images)], results[len(images):]
+
+    changed = False
+
+    for img, preview in zip(images, image_previews):
+        if preview.image_size:
+            img['width'], img['height'] = map(str, preview.image_size)
+            changed = True
+
+    # like Telegram does, only the first link with the open graph tags gets the preview
+    for link, preview in zip(links, link_previews):
+        if not preview.title:
+            continue
+
+        block = soup.new_tag('blockquote')
+
+        title = soup.new_tag('a', href=link, target='_blank')
+        strong = soup.new_tag('strong')
+        strong.string = preview.title
+        title.append(strong)
+        p = soup.new_tag('p')
+        p.append(title)
+        block.append(p)
+
+        if preview.description:
+            description = soup.new_tag('p')
+            description.string = preview.description
+            block.append(description)
+
+        if preview.image:
+            p = soup.new_tag('p')
+            p.append(soup.new_tag('img', src=preview.image))
+            block.append(p)
+
+        soup.append(block)
+        changed = True
+        break
+
+    return str(soup) if changed else html
+
+
+async def enrich_html(html: str) -> str:
+    """
+    Adds the link preview (open graph tags) and the image sizes to the node html.
+    Returns the html as is, if the enrichment fails or does not fit into PREVIEW_BUDGET.
+    The pages fetched too late are still cached for the next time.
+    """
+    if not html or '<a' not in html and '<img' not in html:
+        return html
+
+    task = asyncio.ensure_future(_enrich(html))
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), PREVIEW_BUDGET)
+    except asyncio.TimeoutError:
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return html
+    except Exception:
+        return html
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import pickle
+import zlib
+from typing import Dict
+
+from utils.cache import TTLCache
+
+SNAPSHOT_VERSION = 1
+
+
+class CacheSnapshot:
+    """
+    Saves the registered caches to the file on shutdown and restores them after the restart,
+    so the first requests do not go to RedForester again. The expired entries are not restored.
+    """
+
+    def __init__(self, path: str, logger):
+        self._path = path
+        self._logger = logger
+        self._caches: Dict[str, TTLCache] = {}
+
+    def register(self, name: str, cache: TTLCache):
+        self._caches[name] = cache
+
+    def save(self):
+        if not self._path:
+            return
+
+        try:
+            data = {name: cache.export() for name, cache in self._caches.items()}
+
+            # written next to the old one and renamed, so the killed process leaves the previous snapshot
+            temp_path = self._path + '.tmp'
+            with open(temp_path, 'wb') as file:
+                file.write(zlib.compress(pickle.dumps((SNAPSHOT_VERSION, data), pickle.HIGHEST_PROTOCOL)))
+
+            os.replace(temp_path, self._path)
+
+            self._logger.info(f'Cache snapshot saved: {", ".join(f"{name} {len(entries)}" for name, entries in data.items())}')
+        except Exception as e:
+            self._logger.exception(e)
+
+    def _read(self) -> Dict[str, list]:
+        with open(self._path, 'rb') as file:
+            version, data = pickle.loads(zlib.decompress(file.read()))
+
+        return data if version == SNAPSHOT_VERSION else {}
+
+    async def load(self):
+        """
+        Reads the file in the executor, the caches are filled in the event loop thread
+        """
+        if not self._path or not os.path.exists(self._path):
+            return
+
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        except Exception as e:
+            return self._logger.exception(e)
+
+        restored = {name: cache.restore(data.get(name, [])) for name, cache in self._caches.items()}
+
+        self._logger.info(f'Cache snapshot restored: {", ".join(f"{name} {count}" for name, count in restored.items())}')
@@ -0,0 +1,64 @@
+import importlib
+import os
+import sys
+import time
+from typing import List, Tuple
+
+# Modules which are imported on the first use, the warm-up imports them in the background after the polling started
+LAZY_MODULES = [
+    'rf_api_client',
+    'rf_api_client.models.nodes_api_models',
+    'rf_api_client.models.tags_api_models',
+    'app.rf_client',
+    'bs4',
+    'pathvalidate',
+]
+
+
+class StartupTimer:
+    """
+    Measures the startup phases from the process start (this module import).
+    The budget applies to the 'ready' phase: the polling is started and the critical initialization is done.
+    """
+
+    def __init__(self, budget: float):
+        self._budget = budget
+        self._started = time.perf_counter()
+        self._phases: List[Tuple[str, float]] = []
+        self._first_update_handled = False
+
+    def mark(self, phase: str) -> float:
+        elapsed = time.perf_counter() - self._started
+        self._phases.append((phase, elapsed))
+        return elapsed
+
+    def report(self) -> str:
+        lines = [f'  {phase}: {elapsed * 1000:.0f} ms' for phase, elapsed in self._phases]
+        loaded = [name for name in LAZY_MODULES if name in sys.modules]
+        lines.append(f'  lazy modules loaded: {", ".join(loaded) or "none"}')
+
+        return '\n'.join(lines)
+
+    def ready(self, logger):
+        elapsed = self.mark('ready')
+
+        if elapsed > self._budget:
+            logger.warning(f'Startup took {elapsed:.2f}s, over the {self._budget:.2f}s budget:\n{self.report()}')
+        else:
+            logger.info(f'Startup took {elapsed:.2f}s:\n{self.report()}')
+
+    def first_update_handled(self, logger):
+        if self._first_update_handled:
+            return
+
+        self._first_update_handled = True
+        elapsed = self.mark('first update handled')
+        logger.info(f'First update handled {elapsed:.2f}s after the start')
+
+
+def warm_up_imports():
+    for name in LAZY_MODULES:
+        importlib.import_module(name)
+
+
+startup_timer = StartupTimer(budget=float(os.getenv('RF_KEEPER_STARTUP_BUDGET', '10')))
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import unittest
+
+# the app runs as app/main.py, its modules import each other from there
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'app'))
+
+from utils.admission import AdmissionController, BusyException  # noqa: E402
+
+
+def create_admission(**options) -> AdmissionController:
+    defaults = dict(user_concurrency=1, global_concurrency=10, user_queue=10, global_queue=100, user_rate=60,
+                    user_burst=30)
+    return AdmissionController(**{**defaults, **options})
+
+
+async def hold_slot(admission: AdmissionController, user_id: int, release: asyncio.Event):
+    async with admission.slot(user_id):
+        await release.wait()
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_waiters_cancelled_together(self):
+        async def run():
+            admission = create_admission()
+            release = asyncio.Event()
+
+            tasks = [asyncio.ensure_future(hold_slot(admission, 1, release)) for _ in range(3)]
+            await asyncio.sleep(0)
+
+            for task in tasks:
+                task.cancel()
+
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+            self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results), results)
+            self.assertEqual(admission.in_flight_count, 0)
+            self.assertEqual(admission.waiting_count, 0)
+
+            release.set()
+            await asyncio.wait_for(hold_slot(admission, 1, release), 1)
+
+        asyncio.run(run())
+
+    def test_cancelled_waiter_passes_the_slot_on(self):
+        async def run():
+            admission = create_admission()
+            release = asyncio.Event()
+
+            holder = asyncio.ensure_future(hold_slot(admission, 1, release))
+            cancelled = asyncio.ensure_future(hold_slot(admission, 1, release))
+            waiter = asyncio.ensure_future(hold_slot(admission, 1, release))
+            await asyncio.sleep(0)
+
+            cancelled.cancel()
+            release.set()
+
+            await asyncio.wait_for(asyncio.gather(holder, waiter), 1)
+            self.assertTrue(cancelled.cancelled())
+            self.assertEqual(admission.in_flight_count, 0)
+
+        asyncio.run(run())
+
+    def test_busy_when_user_queue_is_full(self):
+        async def run():
+            admission = create_admission(user_queue=1)
+            release = asyncio.Event()
+
+            tasks = [asyncio.ensure_future(hold_slot(admission, 1, release)) for _ in range(2)]
+            await asyncio.sleep(0)
+
+            with self.assertRaises(BusyException):
+                await hold_slot(admission, 1, release)
+
+            release.set()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()